@@ -0,0 +1,77 @@
+"""
+Zip archives of repo paths for users who download instead of pulling.
+
+Archives are generated by `git archive` from the server-side mirror at the
+branch tip and streamed to the client while they're written to a cache file,
+so nothing is buffered in memory. The cache is keyed by (commit, paths):
+repeated downloads of the same lab are served straight from disk until the
+branch moves on. Least recently used archives (by mtime, which is bumped on
+every download) are removed once the cache grows past ARCHIVE_CACHE_MAX_BYTES.
+"""
+import hashlib
+import os
+import threading
+
+from . import mirror
+from . import util
+
+git = util.lazy_import('git')
+
+_prune_lock = threading.Lock()
+
+
+def cache_path(config, repo_name, commit, paths):
+    """Where the archive of paths at commit is cached."""
+    key = hashlib.sha1('\0'.join(sorted(paths)).encode('utf-8')).hexdigest()
+    return os.path.join(config['ARCHIVE_PATH'], repo_name,
+                        '{}-{}.zip'.format(commit, key[:16]))
+
+
+def start_archive(config, repo_name, commit, paths):
+    """
+    Starts `git archive` for paths at commit in the mirror of repo_name.
+    Returns the process; the zip is written to its stdout.
+    """
+    return git.Git(mirror.mirror_dir(repo_name, config)).execute(
+        ['git', 'archive', '--format=zip', '--prefix={}/'.format(repo_name),
+         commit, '--'] + list(paths),
+        as_process=True,
+    )
+
+
+def copy_chunk(infile, outfile, size):
+    """
+    Reads up to size bytes from infile, writes them to outfile (if given) and
+    returns them. Blocks, so call it off the IOLoop.
+    """
+    chunk = infile.read(size)
+    if chunk and outfile is not None:
+        outfile.write(chunk)
+    return chunk
+
+
+def prune_cache(config):
+    """Removes least recently used archives until the cache fits its budget."""
+    if not _prune_lock.acquire(blocking=False):
+        return
+    try:
+        archives = []
+        for root, _, files in os.walk(config['ARCHIVE_PATH']):
+            for filename in files:
+                if filename.endswith('.zip'):
+                    path = os.path.join(root, filename)
+                    stat = os.stat(path)
+                    archives.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in archives)
+        for _, size, path in sorted(archives):
+            if total <= config['ARCHIVE_CACHE_MAX_BYTES']:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                util.logger.info('Removed cached archive %s', path)
+            except OSError:
+                pass
+    finally:
+        _prune_lock.release()
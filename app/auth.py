@@ -6,8 +6,12 @@ https://github.com/jupyter/nbgrader/blob/master/nbgrader/auth/hubauth.py
 
 """
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
 
 from tornado.web import HTTPError
@@ -24,6 +28,24 @@ def abort(*args, **kwargs):
     raise HTTPError(*args, **kwargs)
 
 
+# Shared by all HubAuth instances so that connections to the hub are reused
+# instead of being opened for every request.
+_session = None
+_session_lock = threading.Lock()
+
+
+def hub_session(config):
+    """requests.Session keeping up to HUB_POOL_SIZE connections to the hub."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(pool_maxsize=config['HUB_POOL_SIZE'])
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
 class HubAuth(object):
     """Jupyter hub authenticator."""
 
@@ -56,7 +78,7 @@ class HubAuth(object):
         if isinstance(data, (dict,)):
             data = json.dumps(data)
 
-        return requests.request(
+        return hub_session(self.config).request(
             method,
             base_url + relative_path,
             headers={
@@ -68,6 +90,34 @@ class HubAuth(object):
             verify=(not self.config['MOCK_AUTH']),
         )
 
+    def warm_up(self):
+        """
+        Fills the connection pool to the hub ahead of the first requests, by
+        making HUB_POOL_SIZE cookie lookups at once the way authenticate()
+        does. The cookie doesn't exist, so the hub answers 404 unless it
+        rejects our API token.
+
+        Returns the status codes the hub answered with. Raises RuntimeError
+        if it rejected the token or failed.
+        """
+        if self.config['MOCK_AUTH']:
+            return None
+
+        path = '/hub/api/authorizations/cookie/{}/interact-warm-up'.format(
+            self.hubapi_cookie)
+        connections = self.config['HUB_POOL_SIZE']
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            responses = list(executor.map(
+                lambda _: self._hubapi_request(path), range(connections)))
+
+        status_codes = sorted(set(response.status_code
+                                  for response in responses))
+        for status_code in status_codes:
+            if status_code == 403 or status_code >= 500:
+                raise RuntimeError(
+                    'Hub answered {} to a cookie lookup'.format(status_code))
+        return status_codes
+
     def authenticate(self, request):
         """Authenticate a request.
         Returns username or flask redirect."""
@@ -0,0 +1,204 @@
+"""
+Adaptive limit on the number of pull/download jobs running at once.
+
+Jobs are network-bound when they fetch and disk-bound when they clone, so no
+fixed pool size fits both. AdaptiveExecutor keeps a pool of JOB_WORKERS_MAX
+threads but only lets `limit` jobs run at a time, and adjusts the limit AIMD
+style (additive increase, multiplicative decrease) after jobs finish:
+
+- the limit is cut by JOB_WORKERS_DECREASE_FACTOR when CPU or IO pressure is
+  above their thresholds
+- it grows by one when jobs are queueing and have recently waited longer than
+  JOB_TARGET_QUEUE_WAIT_S to start, unless the machine is under pressure
+
+How long jobs run is not a signal: a pull of a big repo over a slow network
+takes long without loading the machine, and cutting the limit for it would
+only make the queue longer.
+
+The current limit, load and recent decisions are reported by status() for
+the admin status endpoint.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import util
+
+# Weight of the newest job in the run time and queue wait moving averages
+EWMA_WEIGHT = 0.3
+
+
+def _ewma(average, value):
+    if average is None:
+        return value
+    return average + EWMA_WEIGHT * (value - average)
+
+
+def cpu_pressure():
+    """1-minute load average per CPU, or None where unsupported."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def io_pressure():
+    """
+    Fraction of the last 10s some task was stalled on IO, from Linux PSI
+    (/proc/pressure/io), or None where unavailable.
+    """
+    try:
+        with open('/proc/pressure/io') as infile:
+            for line in infile:
+                if line.startswith('some'):
+                    fields = dict(field.split('=')
+                                  for field in line.split()[1:])
+                    return float(fields['avg10']) / 100
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
+
+
+class AdaptiveExecutor(object):
+    """
+    Executor whose number of concurrently running jobs adapts to queue wait
+    and system pressure. submit() returns a concurrent.futures.Future, so it can
+    be yielded in a coroutine like the ThreadPoolExecutor it replaces.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.running = 0
+        self.latency = None
+        self.queue_wait = None
+        self.last_adjusted = 0
+        self.decisions = deque(maxlen=50)
+        self.config = None
+        self.limit = 0
+        self.executor = None
+
+    def configure(self, config):
+        """Applies the bounds and thresholds of config. Call before use."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.config = config
+        self.limit = config['JOB_WORKERS_INITIAL']
+        self.executor = ThreadPoolExecutor(
+            max_workers=config['JOB_WORKERS_MAX'])
+
+    def submit(self, fn, *args, **kwargs):
+        if self.executor is None:
+            raise RuntimeError('AdaptiveExecutor used before configure()')
+        future = Future()
+        with self.lock:
+            self.queue.append((future, fn, args, kwargs, time.time()))
+        self._dispatch()
+        return future
+
+    def try_submit(self, fn, *args, **kwargs):
+        """
+        Starts fn right away if there is a free job slot and nothing queued,
+        returning its Future, or returns None without queueing it.
+
+        For work that a running job splits off: queueing it could leave the
+        job waiting for a slot while holding one, which deadlocks once every
+        slot is held by such jobs. Run fn on the calling thread when this
+        returns None.
+        """
+        if self.executor is None:
+            raise RuntimeError('AdaptiveExecutor used before configure()')
+        future = Future()
+        with self.lock:
+            if self.queue or self.running >= self.limit:
+                return None
+            future.set_running_or_notify_cancel()
+            self.running += 1
+        self.executor.submit(self._run, future, fn, args, kwargs, time.time())
+        return future
+
+    def _dispatch(self):
+        """Starts queued jobs while we're under the limit."""
+        to_start = []
+        with self.lock:
+            while self.queue and self.running < self.limit:
+                job = self.queue.popleft()
+                if not job[0].set_running_or_notify_cancel():
+                    continue
+                self.running += 1
+                to_start.append(job)
+
+        for job in to_start:
+            self.executor.submit(self._run, *job)
+
+    def _run(self, future, fn, args, kwargs, queued_at):
+        started_at = time.time()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.running -= 1
+            self._adjust(time.time() - started_at, started_at - queued_at)
+            self._dispatch()
+
+    def _adjust(self, job_latency, queue_wait):
+        config = self.config
+        now = time.time()
+
+        with self.lock:
+            self.latency = _ewma(self.latency, job_latency)
+            self.queue_wait = _ewma(self.queue_wait, queue_wait)
+            if now - self.last_adjusted < config['JOB_ADJUST_INTERVAL_S']:
+                return
+            self.last_adjusted = now
+
+            cpu = cpu_pressure()
+            io = io_pressure()
+            old_limit = self.limit
+
+            if cpu is not None and cpu > config['JOB_CPU_PRESSURE_MAX']:
+                reason = 'cpu pressure {:.2f}'.format(cpu)
+            elif io is not None and io > config['JOB_IO_PRESSURE_MAX']:
+                reason = 'io pressure {:.2f}'.format(io)
+            else:
+                reason = None
+
+            if reason is not None:
+                self.limit = max(config['JOB_WORKERS_MIN'], int(
+                    self.limit * config['JOB_WORKERS_DECREASE_FACTOR']))
+            elif (self.queue and
+                  self.queue_wait > config['JOB_TARGET_QUEUE_WAIT_S']):
+                self.limit = min(config['JOB_WORKERS_MAX'], self.limit + 1)
+                reason = '{} queued, waited {:.1f}s'.format(len(self.queue),
+                                                           self.queue_wait)
+            if self.limit == old_limit:
+                return
+
+            self.decisions.append({
+                'time': now,
+                'from': old_limit,
+                'to': self.limit,
+                'reason': reason,
+            })
+
+        util.logger.info('Job limit %d -> %d (%s)', old_limit, self.limit,
+                         reason)
+
+    def status(self):
+        with self.lock:
+            return {
+                'limit': self.limit,
+                'min': self.config['JOB_WORKERS_MIN'],
+                'max': self.config['JOB_WORKERS_MAX'],
+                'running': self.running,
+                'queued': len(self.queue),
+                'latency_s': self.latency,
+                'queue_wait_s': self.queue_wait,
+                'cpu_pressure': cpu_pressure(),
+                'io_pressure': io_pressure(),
+                'decisions': list(self.decisions),
+            }
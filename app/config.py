@@ -47,6 +47,149 @@ class Config(object):
     # notebook exists under user's account
     AUTH_TIMEOUT_S = 10
 
+    # Per-phase job timeouts. A job that runs past one of these is cancelled:
+    # the git process is killed or the transfer aborted and the user sees an
+    # error.
+    GIT_CLONE_TIMEOUT_S = 300
+    GIT_FETCH_TIMEOUT_S = 120
+    # merge and read-tree
+    GIT_LOCAL_TIMEOUT_S = 120
+    # Whole download of a ?file= link, and each individual socket operation
+    DOWNLOAD_TIMEOUT_S = 60
+    DOWNLOAD_SOCKET_TIMEOUT_S = 10
+
+    # Bounds on the number of pull/download jobs running at once. The limit
+    # starts at JOB_WORKERS_INITIAL and is adjusted between these bounds.
+    JOB_WORKERS_MIN = 2
+    JOB_WORKERS_MAX = 16
+    JOB_WORKERS_INITIAL = 4
+    # The limit is multiplied by JOB_WORKERS_DECREASE_FACTOR when the load
+    # average per CPU is above JOB_CPU_PRESSURE_MAX or the fraction of time
+    # stalled on IO is above JOB_IO_PRESSURE_MAX. Otherwise it grows by one
+    # while jobs queue and the average job waits longer than
+    # JOB_TARGET_QUEUE_WAIT_S to start.
+    JOB_TARGET_QUEUE_WAIT_S = 2
+    JOB_CPU_PRESSURE_MAX = 1.5
+    JOB_IO_PRESSURE_MAX = 0.4
+    JOB_WORKERS_DECREASE_FACTOR = 0.5
+    # Minimum time between two adjustments
+    JOB_ADJUST_INTERVAL_S = 5
+    # Most repos a single link may pull at once, see
+    # handlers.parse_repo_groups
+    MAX_REPO_GROUPS = 4
+
+    # Background git maintenance of user repos (repack, prune, commit-graph)
+    MAINTENANCE_ENABLED = True
+    # How often to check whether the server is idle enough to run a cycle
+    MAINTENANCE_CHECK_INTERVAL_S = 60
+    # Wall-clock budget for a single maintenance cycle
+    MAINTENANCE_BUDGET_S = 30
+    # Minimum time between two maintenance runs on the same repo
+    MAINTENANCE_REPO_INTERVAL_S = 24 * 60 * 60
+    # Pack loose objects once a repo has at least this many
+    MAINTENANCE_LOOSE_OBJECTS = 100
+    # Consolidate packs with a multi-pack-index once there are this many
+    MAINTENANCE_MAX_PACKS = 10
+    # Most bytes of small packs multi-pack-index repack rewrites into one
+    # per run, so a cycle never rewrites a whole repo
+    MAINTENANCE_REPACK_BATCH_BYTES = 32 * 1024 ** 2
+
+    # Where the server-side mirrors of the Github repos are kept
+    MIRROR_PATH = '/srv/interact/mirrors'
+    # Pulls go to Github instead of a mirror that is older than this
+    MIRROR_MAX_AGE_S = 60 * 60
+    # Without a webhook, pulls check that the mirror is up to date with
+    # `git ls-remote`, whose result is reused for this long
+    MIRROR_TIP_CACHE_S = 10
+    MIRROR_TIP_TIMEOUT_S = 10
+    # A link path missing from the mirror waits this long for a refresh of
+    # the mirror, if Github's branch has moved on, before it is rejected
+    MIRROR_MISS_REFRESH_TIMEOUT_S = 20
+
+    # Number of (repo, commit) tree indexes kept for validating link paths
+    TREE_INDEX_CACHE_SIZE = 32
+
+    # Idle git.Repo handles of user repos kept between pulls, see
+    # repo_pool.py. 0 disables pooling.
+    REPO_POOL_SIZE = 64
+
+    # Repos that users who haven't logged in may download and check paths
+    # of. GITHUB_ORG can read private repos, so everything else requires
+    # logging in to the hub. Comma-separated in INTERACT_PUBLIC_REPOS.
+    PUBLIC_REPOS = [repo for repo in
+                    os.environ.get('INTERACT_PUBLIC_REPOS',
+                                   default='').split(',')
+                    if repo]
+
+    # Where zip archives of repo paths are cached for the download endpoint
+    ARCHIVE_PATH = '/srv/interact/archives'
+    # Least recently downloaded archives are removed past this total size
+    ARCHIVE_CACHE_MAX_BYTES = 2 * 1024 ** 3
+    # Size of the chunks archives are streamed to clients in
+    ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+    # Repos to mirror and index on startup, before the instance reports
+    # ready. Comma-separated in INTERACT_HOT_REPOS, eg. "textbook,data8assets"
+    HOT_REPOS = [repo for repo in
+                 os.environ.get('INTERACT_HOT_REPOS', default='').split(',')
+                 if repo]
+    # Longest a warm-up step waits for a mirror refresh; a warm-up still
+    # running after this long is logged and reported in admin/status
+    WARMUP_TIMEOUT_S = 120
+    # Report ready after WARMUP_TIMEOUT_S or once every step has finished,
+    # even if some failed. Otherwise the instance stays not ready until the
+    # warm-up has finished without errors.
+    WARMUP_READY_ON_FAILURE = False
+    # Failed warm-up steps are retried after this long, doubling up to
+    # WARMUP_RETRY_MAX_S between attempts
+    WARMUP_RETRY_MIN_S = 5
+    WARMUP_RETRY_MAX_S = 300
+
+    # Connections to the hub API kept open for authentication requests
+    HUB_POOL_SIZE = 10
+
+    # Measure IOLoop lag and capture the stack of whatever blocks the loop
+    # for longer than WATCHDOG_THRESHOLD_S, see watchdog.py
+    WATCHDOG_ENABLED = True
+    WATCHDOG_INTERVAL_S = 0.1
+    WATCHDOG_THRESHOLD_S = 0.5
+    # Number of recent lag samples the percentiles are computed over
+    WATCHDOG_WINDOW = 3000
+    # Number of blocking call sites reported by admin/status
+    WATCHDOG_TOP_SITES = 10
+
+    # Record anonymized request traces for benchmarks/replay.py
+    TRACE_ENABLED = False
+    TRACE_PATH = '/tmp/interact-traces.jsonl'
+    # Salt of the user hashes in traces. Keep it stable to match users
+    # across restarts; a random one is used when empty.
+    TRACE_SALT = os.environ.get('INTERACT_TRACE_SALT', default='')
+
+    # Secret configured for the Github push webhook. The webhook endpoint is
+    # disabled when this is empty.
+    WEBHOOK_SECRET = os.environ.get('INTERACT_WEBHOOK_SECRET', default='')
+
+    # Level of the JSON logs written to stderr
+    LOG_LEVEL = 'INFO'
+
+    # Git progress lines are logged at most this often per job; the client
+    # still gets every line over the websocket.
+    PROGRESS_LOG_INTERVAL_S = 5
+
+    # Token for the admin endpoints, passed as "Authorization: token <...>".
+    # The admin endpoints are disabled when this is empty.
+    ADMIN_TOKEN = os.environ.get('INTERACT_ADMIN_TOKEN', default='')
+
+    # Where the on-demand profiler writes its output
+    PROFILE_PATH = '/tmp/interact-profiles'
+    # Time between two stack samples
+    PROFILE_SAMPLE_INTERVAL_S = 0.005
+    # Upper bound on a single profiling session
+    PROFILE_MAX_SECONDS = 300
+    # Stack depth recorded by tracemalloc and number of sites reported
+    PROFILE_TRACEMALLOC_FRAMES = 10
+    PROFILE_TRACEMALLOC_TOP = 50
+
     def __getitem__(self, attr):
         """
         Temporary hack in order to maintain Flask config-like config usage.
@@ -102,12 +245,23 @@ class DevelopmentConfig(Config):
     # JupyterHub API token
     API_TOKEN = 'your_token_here'
 
+    ADMIN_TOKEN = 'your_admin_token_here'
+
+    # Used by remote/send_push_hook.py
+    WEBHOOK_SECRET = 'your_webhook_secret_here'
+
     # Cookie name?
     COOKIE = 'interact'
 
     # where file is copied to
     COPY_PATH = 'app/static/users/{username}'
 
+    # where the upstream repos are mirrored
+    MIRROR_PATH = 'mirrors'
+
+    # where zip archives for the download endpoint are cached
+    ARCHIVE_PATH = 'archives'
+
     # where users are redirected upon file download success
     FILE_REDIRECT_PATH = '/static/users/{username}/{destination}'
 
@@ -131,6 +285,12 @@ class DevelopmentConfig(Config):
     # notebook exists under user's account
     AUTH_TIMEOUT_S = 0.01
 
+    LOG_LEVEL = 'DEBUG'
+
+    # Run git maintenance eagerly so it can be tried out locally
+    MAINTENANCE_CHECK_INTERVAL_S = 10
+    MAINTENANCE_REPO_INTERVAL_S = 60
+
 
 class TestConfig(Config):
     """Configuration for testing mode"""
@@ -147,12 +307,23 @@ class TestConfig(Config):
     # JupyterHub API token
     API_TOKEN = 'your_token_here'
 
+    ADMIN_TOKEN = 'your_admin_token_here'
+
+    # Used by remote/send_push_hook.py
+    WEBHOOK_SECRET = 'your_webhook_secret_here'
+
     # Cookie name?
     COOKIE = 'interact'
 
     # where file is copied to
     COPY_PATH = 'app/static/users/{username}'
 
+    # where the upstream repos are mirrored
+    MIRROR_PATH = 'mirrors'
+
+    # where zip archives for the download endpoint are cached
+    ARCHIVE_PATH = 'archives'
+
     # where users are redirected upon file download success
     FILE_REDIRECT_PATH = '/static/users/{username}/{destination}'
 
@@ -167,3 +338,7 @@ class TestConfig(Config):
 
     # allowed file extensions
     ALLOWED_FILETYPES = ['ipynb']
+
+    MAINTENANCE_ENABLED = False
+
+    LOG_LEVEL = 'WARNING'
@@ -4,31 +4,39 @@ from urllib.request import urlopen
 
 from . import util
 from . import messages
+from .jobs import CancelToken, JobCancelled, shutdown_response
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 def download_file_and_redirect(**kwargs):
     """
     Downloads the file from file_url and saves it into the COPY_PATH in config.
 
-    Must be called with username, file_url, config keyword args.
+    Must be called with username, file_url, config keyword args. An optional
+    cancel_token keyword arg aborts the transfer when cancelled.
 
     Returns a message from messages.py.
     """
     username = kwargs['username']
     file_url = kwargs['file_url']
     config = kwargs['config']
+    cancel_token = kwargs.get('cancel_token') or CancelToken()
 
     assert username and file_url and config
 
     try:
-        file_contents = _get_remote_file(config, file_url)
+        with util.log_phase('download'), cancel_token.phase(
+                'download', config['DOWNLOAD_TIMEOUT_S']):
+            file_contents = _get_remote_file(config, file_url, cancel_token)
         destination = os.path.basename(file_url)
         path = util.construct_path(config['COPY_PATH'], locals())
 
         # destination might change if the file results in a copy
-        destination = _write_to_destination(
-            file_contents, path, destination, config)
-        util.chown(path, destination)
+        with util.log_phase('write'):
+            destination = _write_to_destination(
+                file_contents, path, destination, config)
+            util.chown(path, destination)
 
         redirect_url = util.construct_path(config['FILE_REDIRECT_PATH'], {
             'username': username,
@@ -42,17 +50,42 @@ def download_file_and_redirect(**kwargs):
         error = ('Source file "{}" does not exist or is not accessible.'
                  .format(file_url))
         return messages.error(error)
+    except JobCancelled as e:
+        util.logger.info('Download cancelled: %s', e)
+        return messages.error('Download cancelled: {}'.format(e))
     except Exception as e:
         error = ('Unhandled error: {}'.format(e))
         return messages.error(error)
 
 
-def _get_remote_file(config, source):
-    """Fetches file, throws an HTTPError if the file is not accessible."""
+def _get_remote_file(config, source, cancel_token=None):
+    """
+    Fetches file, throws an HTTPError if the file is not accessible.
+
+    The file is read in chunks so that a cancelled download stops promptly.
+    """
     if not source.startswith(config['ALLOWED_DOMAIN']):
         raise ValueError('File not from allowed domain')
 
-    return urlopen(source).read().decode('utf-8')
+    cancel_token = cancel_token or CancelToken()
+    chunks = []
+    response = urlopen(source, timeout=config['DOWNLOAD_SOCKET_TIMEOUT_S'])
+    with response, cancel_token.on_cancel(shutdown_response(response)):
+        while True:
+            cancel_token.check()
+            try:
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+            except (OSError, ValueError):
+                # Reading a response shut down by the cancel callback
+                cancel_token.check()
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+    # A shut down response reads as if it ended early
+    cancel_token.check()
+
+    return b''.join(chunks).decode('utf-8')
 
 
 def _write_to_destination(file_contents, path, destination, config):
@@ -0,0 +1,353 @@
+"""
+Background maintenance for the user repositories under COPY_PATH.
+
+Every pull may leave behind a WIP commit, a merge commit and a handful of
+loose objects. Over a semester that makes status, merge and read-tree slower
+for long-lived users, so during idle periods we walk the user repos and run
+incremental repacks, prunes and commit-graph / multi-pack-index writes.
+
+Maintenance never competes with user traffic: a cycle only starts when no
+pull is running, stops as soon as one starts, skips any repo with an active
+job and is bounded by MAINTENANCE_BUDGET_S of wall-clock time. The git
+processes themselves run at the lowest CPU and IO priority.
+"""
+import configparser
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+from tornado.ioloop import PeriodicCallback
+
+from . import repo_pool
+from . import util
+
+# Repos that currently have a pull running on them, with a count since the
+# same user can have several tabs pulling the same repo.
+_active_repos = Counter()
+_active_lock = threading.Lock()
+
+
+@contextmanager
+def repo_in_use(repo_dir):
+    """
+    Marks repo_dir as having an active job for the duration of the block so
+    that maintenance leaves it alone.
+    """
+    repo_dir = os.path.abspath(repo_dir)
+    with _active_lock:
+        _active_repos[repo_dir] += 1
+    try:
+        yield
+    finally:
+        with _active_lock:
+            _active_repos[repo_dir] -= 1
+            if _active_repos[repo_dir] <= 0:
+                del _active_repos[repo_dir]
+
+
+# One lock per repo_dir being cloned, with the number of jobs holding or
+# waiting for it so that it can be dropped afterwards.
+_clone_locks = {}
+
+
+@contextmanager
+def clone_lock(repo_dir):
+    """
+    Serializes the jobs that may clone repo_dir, so that a second job waits
+    for the first clone instead of failing on the existing directory and
+    removing the first job's clone.
+    """
+    repo_dir = os.path.abspath(repo_dir)
+    with _active_lock:
+        lock, waiters = _clone_locks.get(repo_dir, (threading.Lock(), 0))
+        _clone_locks[repo_dir] = (lock, waiters + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _active_lock:
+            lock, waiters = _clone_locks[repo_dir]
+            if waiters <= 1:
+                del _clone_locks[repo_dir]
+            else:
+                _clone_locks[repo_dir] = (lock, waiters - 1)
+
+
+def is_repo_in_use(repo_dir):
+    """Is there an active job on repo_dir?"""
+    with _active_lock:
+        return os.path.abspath(repo_dir) in _active_repos
+
+
+def repo_use_count(repo_dir):
+    """Number of jobs currently running on repo_dir."""
+    with _active_lock:
+        return _active_repos[os.path.abspath(repo_dir)]
+
+
+def is_idle():
+    """Are there no active jobs at all?"""
+    with _active_lock:
+        return not _active_repos
+
+
+def is_idle_but(repo_dir):
+    """
+    Is the only active job a single one on repo_dir? That's the case while
+    maintenance runs on repo_dir and no pull has started.
+    """
+    repo_dir = os.path.abspath(repo_dir)
+    with _active_lock:
+        return (list(_active_repos) == [repo_dir] and
+                _active_repos[repo_dir] == 1)
+
+
+def _origin_url(repo_dir):
+    """
+    URL of the origin remote of repo_dir, or None if it has none.
+
+    Parses the repo's config file rather than starting a git process for
+    every user repo each cycle. git would also refuse repos owned by other
+    users.
+    """
+    parser = configparser.ConfigParser(strict=False, interpolation=None)
+    try:
+        parser.read(os.path.join(repo_dir, '.git', 'config'))
+        return parser.get('remote "origin"', 'url', fallback=None)
+    except (configparser.Error, UnicodeDecodeError):
+        return None
+
+
+def _without_credentials(url):
+    """url without the user and token, eg. the API token in GITHUB_ORG."""
+    parts = urlsplit(url)
+    netloc = parts.netloc.rpartition('@')[2]
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+def find_user_repos(config):
+    """
+    Yields (username, repo_dir) for every repo under COPY_PATH that we cloned
+    from GITHUB_ORG.
+
+    COPY_PATH looks like /home/{username}, so every directory in the part
+    before {username} is treated as a user directory and every child of a
+    user directory with a .git folder as a candidate. Repos the users
+    created or cloned themselves are left alone. URLs are compared without
+    credentials, so repos cloned before the API token changed are kept.
+    """
+    org = _without_credentials(config['GITHUB_ORG'])
+    users_root = config['COPY_PATH'].split('{username}')[0] or '.'
+    try:
+        usernames = sorted(os.listdir(users_root))
+    except FileNotFoundError:
+        return
+
+    for username in usernames:
+        user_dir = util.construct_path(config['COPY_PATH'],
+                                       {'username': username})
+        if not os.path.isdir(user_dir):
+            continue
+        try:
+            children = sorted(os.listdir(user_dir))
+        except OSError:
+            continue
+        for child in children:
+            repo_dir = os.path.join(user_dir, child)
+            if not os.path.isdir(os.path.join(repo_dir, '.git')):
+                continue
+            origin = _origin_url(repo_dir)
+            if origin and _without_credentials(origin).startswith(org):
+                yield username, repo_dir
+
+
+def _run_git(repo_dir, args, timeout):
+    """
+    Runs a low-priority git command in repo_dir, returning its stdout.
+
+    Raises subprocess.CalledProcessError or subprocess.TimeoutExpired.
+    """
+    command = ['git', '-c', 'pack.threads=1'] + args
+    if shutil.which('ionice'):
+        command = ['ionice', '-c', '3'] + command
+    if shutil.which('nice'):
+        command = ['nice', '-n', '19'] + command
+
+    result = subprocess.run(
+        command,
+        cwd=repo_dir,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=max(timeout, 1),
+        check=True,
+    )
+    return result.stdout.decode('utf-8')
+
+
+def _count_objects(repo_dir, timeout):
+    """Returns the output of git count-objects -v as a dict of ints."""
+    counts = {}
+    for line in _run_git(repo_dir, ['count-objects', '-v'], timeout).split('\n'):
+        if ':' in line:
+            key, value = line.split(':', 1)
+            try:
+                counts[key.strip()] = int(value)
+            except ValueError:
+                pass
+    return counts
+
+
+def maintain_repo(repo_dir, config, deadline):
+    """
+    Runs incremental maintenance on a single repo, stopping at deadline or
+    as soon as a pull starts. Call it inside repo_in_use(repo_dir).
+
+    Steps that the installed git doesn't support are logged and skipped.
+    Returns the list of steps that completed.
+    """
+    def remaining():
+        return deadline - time.time()
+
+    # Its cat-file processes would keep packs we're about to drop open
+    repo_pool.pool.discard(repo_dir)
+
+    counts = _count_objects(repo_dir, remaining())
+    steps = []
+
+    if counts.get('count', 0) >= config['MAINTENANCE_LOOSE_OBJECTS']:
+        # Pack loose objects into a new pack without touching existing ones
+        steps.append(('repack', ['repack', '-d', '-l', '-q']))
+        steps.append(('prune-packed', ['prune-packed', '-q']))
+
+    # Only drops unreachable objects older than the grace period, so this is
+    # safe even if a pull starts while we're running.
+    steps.append(('prune', ['prune', '--expire=2.weeks.ago']))
+
+    if counts.get('packs', 0) >= config['MAINTENANCE_MAX_PACKS']:
+        steps.append(('multi-pack-index',
+                      ['multi-pack-index', 'write']))
+        steps.append(('multi-pack-index-expire',
+                      ['multi-pack-index', 'expire']))
+        batch_size = '--batch-size={}'.format(
+            config['MAINTENANCE_REPACK_BATCH_BYTES'])
+        steps.append(('multi-pack-index-repack',
+                      ['multi-pack-index', 'repack', batch_size]))
+
+    steps.append(('commit-graph',
+                  ['commit-graph', 'write', '--reachable', '--split']))
+
+    completed = []
+    for name, args in steps:
+        if remaining() <= 0:
+            util.logger.info('Maintenance budget spent in {}'.format(repo_dir))
+            break
+        if not is_idle_but(repo_dir):
+            util.logger.info('Pull started, stopping maintenance of {}'
+                             .format(repo_dir))
+            break
+        try:
+            _run_git(repo_dir, args, remaining())
+            completed.append(name)
+        except subprocess.CalledProcessError as e:
+            util.logger.warn('Maintenance step {} failed in {}: {}'.format(
+                name, repo_dir, e.stderr.decode('utf-8').strip()))
+        except subprocess.TimeoutExpired:
+            util.logger.warn('Maintenance step {} timed out in {}'.format(
+                name, repo_dir))
+            break
+
+    return completed
+
+
+class MaintenanceScheduler(object):
+    """
+    Periodically runs maintenance on user repos while the server is idle.
+
+    Call start() once the IOLoop is running. The actual git work happens on a
+    dedicated single thread so it never takes a slot from the job pool.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.periodic = None
+
+        # repo_dir -> time.time() of the last completed maintenance
+        self.last_maintained = {}
+
+    def start(self):
+        if not self.config['MAINTENANCE_ENABLED']:
+            util.logger.info('Git maintenance disabled.')
+            return
+
+        self.periodic = PeriodicCallback(
+            self._tick, self.config['MAINTENANCE_CHECK_INTERVAL_S'] * 1000)
+        self.periodic.start()
+        util.logger.info('Git maintenance scheduler started.')
+
+    def stop(self):
+        if self.periodic:
+            self.periodic.stop()
+
+    def _tick(self):
+        if self.future is not None and not self.future.done():
+            return
+        if not is_idle():
+            return
+        self.future = self.executor.submit(self.run_cycle)
+
+    def run_cycle(self):
+        """
+        Maintains as many due repos as fit in the budget, oldest first.
+
+        Returns the number of repos maintained.
+        """
+        config = self.config
+        start = time.time()
+        deadline = start + config['MAINTENANCE_BUDGET_S']
+        min_age = config['MAINTENANCE_REPO_INTERVAL_S']
+
+        due = [(username, repo_dir)
+               for username, repo_dir in find_user_repos(config)
+               if start - self.last_maintained.get(repo_dir, 0) >= min_age]
+        due.sort(key=lambda user_repo: self.last_maintained.get(user_repo[1], 0))
+
+        maintained = 0
+        for username, repo_dir in due:
+            if time.time() >= deadline:
+                break
+            if not is_idle():
+                util.logger.info('Pull started, pausing git maintenance.')
+                break
+            if is_repo_in_use(repo_dir):
+                continue
+
+            try:
+                with repo_in_use(repo_dir):
+                    completed = maintain_repo(repo_dir, config, deadline)
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired, OSError) as e:
+                util.logger.warn('Maintenance failed in {}: {}'.format(
+                    repo_dir, e))
+                continue
+            finally:
+                # Git may have written new packs/graphs as the server user
+                if not config['MOCK_AUTH']:
+                    util.chown_dir(os.path.join(repo_dir, '.git'), username)
+
+            self.last_maintained[repo_dir] = time.time()
+            maintained += 1
+            util.logger.info('Maintained {} ({})'.format(
+                repo_dir, ', '.join(completed)))
+
+        if maintained:
+            util.logger.info('Git maintenance cycle: {} repos in {:.1f}s'
+                             .format(maintained, time.time() - start))
+        return maintained
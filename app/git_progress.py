@@ -1,3 +1,5 @@
+import time
+import threading
 from collections import deque
 
 import git
@@ -15,28 +17,68 @@ class Progress(git.RemoteProgress):
     the payload.
 
     We define a callback in the RequestHandler to emit updates to the socket.
+
+    Git emits a progress line for every few objects, so lines are only logged
+    every log_interval seconds and when a stage (counting, receiving, ...)
+    finishes; every line is still passed to the callback.
     """
-    def __init__(self, username, callback, max_lines=10):
+    def __init__(self, username, callback, max_lines=10, log_interval=5):
         git.RemoteProgress.__init__(self)
         self.lines = deque(maxlen=max_lines)
+        # Children append to the same lines from other threads
+        self.lines_lock = threading.Lock()
         self.username = username
         self.callback = callback
+        self.log_interval = log_interval
+        self.last_logged = 0
+        self.skipped = 0
+        self.prefix = None
+
+    def child(self, prefix):
+        """
+        Progress for one of several concurrent pulls. Its lines go into this
+        object's log, prefixed with [prefix], and use the same callback.
+        """
+        child = Progress(self.username, self.callback,
+                         log_interval=self.log_interval)
+        child.lines = self.lines
+        child.lines_lock = self.lines_lock
+        child.prefix = prefix
+        return child
+
+    def _prefixed(self, line):
+        if self.prefix is None:
+            return line
+        return '[{}] {}'.format(self.prefix, line)
 
-    def _create_message(self):
-        lines = list(self.lines)
-        return messages.log('\n'.join(lines))
+    def _add_line(self, line):
+        with self.lines_lock:
+            self.lines.append(self._prefixed(line))
+            lines = list(self.lines)
+        self.callback(messages.log('\n'.join(lines)))
 
     def line_dropped(self, line):
-        util.logger.info('({}) {}'.format(self.username, line))
-        self.lines.append(line)
-        self.callback(self._create_message())
+        util.logger.info('(%s) %s', self.username, self._prefixed(line))
+        self._add_line(line)
 
-    def update(self, *args):
+    def update(self, op_code, *args):
         # The docs say:
         #
         #     You may read the contents of the current line in self._cur_line
         #
         # So that's what we're going to do...
-        util.logger.info('({}) {}'.format(self.username, self._cur_line))
-        self.lines.append(self._cur_line)
-        self.callback(self._create_message())
+        self._log_sampled(op_code)
+        self._add_line(self._cur_line)
+
+    def _log_sampled(self, op_code):
+        now = time.time()
+        stage_done = bool(op_code & self.END)
+        if not stage_done and now - self.last_logged < self.log_interval:
+            self.skipped += 1
+            return
+
+        util.logger.info('(%s) %s', self.username,
+                         self._prefixed(self._cur_line),
+                         extra={'progress_lines_skipped': self.skipped})
+        self.last_logged = now
+        self.skipped = 0
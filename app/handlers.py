@@ -4,34 +4,194 @@
             (2) authenticate and commence copying
 - Progress : page containing live updates on server's progress, redirects to
              new content once pull or clone is complete
+- Download : streams a zip of repo paths built from the server-side mirror
+- Ready : readiness probe, see warmup.py
+- Webhook : receives Github push notifications to refresh mirrors
+- Admin : token-protected operator endpoints (profiling, status)
 """
+import hashlib
+import hmac
 import json
+import os
+import posixpath
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import timedelta
 from operator import xor
 from concurrent.futures import ThreadPoolExecutor
 
 from tornado import gen
+from tornado import web
+from tornado.iostream import StreamClosedError
 from tornado.options import options
 from tornado.web import RequestHandler
-from tornado.websocket import WebSocketHandler
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
 from webargs import fields
 from webargs.tornadoparser import use_args
 
+from . import archive
 from . import messages
+from . import mirror
+from . import repo_pool
+from . import tree_index
 from . import util
 from .auth import HubAuth
+from .concurrency import AdaptiveExecutor
 from .download_file_and_redirect import download_file_and_redirect
-from .git_progress import Progress
-from .pull_from_github import pull_from_github
+from .jobs import JobRegistry
+from .profiling import profiler
+from .tracing import recorder
+from .watchdog import watchdog
 
-thread_pool = ThreadPoolExecutor(max_workers=4)
+# Configured by InteractApp, see concurrency.py
+thread_pool = AdaptiveExecutor()
+# Tree index lookups run git, but shouldn't queue behind long pulls
+index_pool = ThreadPoolExecutor(max_workers=2)
+# Disk and pipe reads of streamed archives
+archive_pool = ThreadPoolExecutor(max_workers=4)
+job_registry = JobRegistry()
 
 url_args = {
     'file': fields.Str(),
 
-    'repo': fields.Str(),
+    'repo': fields.List(fields.Str()),
     'path': fields.List(fields.Str()),
 }
 
+archive_args = {
+    'repo': fields.Str(required=True),
+    'path': fields.List(fields.Str(), required=True),
+}
+
+profile_args = {
+    'jobs': fields.Int(),
+    'seconds': fields.Float(),
+}
+
+
+@gen.coroutine
+def resolve_git_paths(repo_name, paths):
+    """
+    Checks paths against the tree index of repo_name's branch tip.
+
+    Returns (index, normalized paths, missing paths). Without an index (no
+    fresh mirror yet) the paths are returned unchecked and index is None.
+    """
+    index = yield index_pool.submit(tree_index.get_index, repo_name,
+                                    options.config)
+    if index is None:
+        return None, paths, []
+
+    normalized = [index.normalize(path) for path in paths]
+    if None in normalized:
+        # The paths may have been pushed since the mirror was refreshed
+        index = yield refreshed_index(index)
+        normalized = [index.normalize(path) for path in paths]
+
+    missing = [path for path, found in zip(paths, normalized) if not found]
+    return index, normalized, missing
+
+
+@gen.coroutine
+def refreshed_index(index):
+    """
+    Refreshes the mirror index was built from if Github's branch has moved on
+    since, and returns the index of the new tip. Returns index itself if the
+    branch hasn't moved, or the refresh fails or takes longer than
+    MIRROR_MISS_REFRESH_TIMEOUT_S.
+    """
+    config = options.config
+    repo_name = index.repo_name
+    tip = yield index_pool.submit(mirror.remote_tip, repo_name, config)
+    if tip is None or tip == index.commit:
+        return index
+
+    util.logger.info('%s moved on to %s, refreshing its mirror', repo_name,
+                     tip[:7])
+    try:
+        yield gen.with_timeout(
+            timedelta(seconds=config['MIRROR_MISS_REFRESH_TIMEOUT_S']),
+            mirror.refresher.request_refresh(repo_name, config))
+    except Exception as e:
+        util.logger.warn('Could not refresh the mirror of %s: %s',
+                         repo_name, e)
+        return index
+
+    new_index = yield index_pool.submit(tree_index.get_index, repo_name,
+                                        config)
+    return new_index or index
+
+
+def is_public_repo(repo_name):
+    """
+    Whether repo_name is in PUBLIC_REPOS, ie. can be served to users who
+    haven't logged in. GITHUB_ORG carries an API token that can read
+    private repos too.
+    """
+    return repo_name in options.config['PUBLIC_REPOS']
+
+
+def parse_repo_groups(repos, paths, max_groups):
+    """
+    Groups the path= values of a link by repo. A link can pull from several
+    repos at once:
+
+        ?repo=lab&repo=data&path=lab01&path=data:tables/cities.csv
+
+    Paths prefixed with one of the link's repos and a colon belong to that
+    repo, all others to the first repo.
+
+    Returns a list of (repo, paths) in the order the repos were given. Raises
+    ValueError if there are no repos, a repo ends up without paths or there
+    are more than max_groups repos.
+    """
+    if not repos:
+        raise ValueError('No repo given')
+    groups = OrderedDict((repo, []) for repo in repos)
+    if len(groups) > max_groups:
+        raise ValueError('A link can pull at most {} repos'.format(max_groups))
+    for path in paths:
+        prefix, _, rest = path.partition(':')
+        if rest and prefix in groups:
+            groups[prefix].append(rest)
+        else:
+            groups[repos[0]].append(path)
+
+    empty = [repo for repo, repo_paths in groups.items() if not repo_paths]
+    if empty:
+        raise ValueError('No paths given for {}'.format(', '.join(empty)))
+    return list(groups.items())
+
+
+def repo_groups_query(groups):
+    """Inverse of parse_repo_groups, as a query string."""
+    first_repo = groups[0][0]
+    values = ['repo={}'.format(repo) for repo, _ in groups]
+    for repo, paths in groups:
+        for path in paths:
+            values.append('path={}'.format(
+                path if repo == first_repo else repo + ':' + path))
+    return '&'.join(values)
+
+
+@gen.coroutine
+def resolve_repo_groups(groups):
+    """
+    Runs resolve_git_paths for every (repo, paths) group concurrently.
+
+    Returns (groups with normalized paths, indexes, missing) where missing
+    lists 'repo: path' for each path that doesn't exist.
+    """
+    results = yield [resolve_git_paths(repo, paths) for repo, paths in groups]
+
+    resolved, indexes, missing = [], [], []
+    for (repo, _), (index, paths, repo_missing) in zip(groups, results):
+        resolved.append((repo, paths))
+        indexes.append(index)
+        missing.extend('{}: {}'.format(repo, path) for path in repo_missing)
+    return resolved, indexes, missing
+
 
 class LandingHandler(RequestHandler):
     """
@@ -55,14 +215,26 @@ class LandingHandler(RequestHandler):
 
     Authenticates, then pulls content into user's file system.
     Note: Only the gh-pages branch is pulled from Github.
+
+    Several repos can be pulled at once, see parse_repo_groups:
+
+        ?repo=lab&repo=data&path=lab01&path=data:tables
     """
+    @gen.coroutine
     @use_args(url_args)
     def get(self, args):
         is_file_request = ('file' in args)
         is_git_request = ('repo' in args and 'path' in args)
         valid_request = xor(is_file_request, is_git_request)
         if not valid_request:
-            self.render('404.html')
+            return self.render('404.html')
+
+        if is_git_request:
+            try:
+                groups = parse_repo_groups(args['repo'], args['path'],
+                                           options.config['MAX_REPO_GROUPS'])
+            except ValueError:
+                return self.render('404.html')
 
         hubauth = HubAuth(options.config)
         # authenticate() returns either a username as a string or a redirect
@@ -70,21 +242,47 @@ class LandingHandler(RequestHandler):
         util.logger.info("authenticate returned: {}".format(redirection))
         is_redirect = (redirection.startswith('/') or
                        redirection.startswith('http'))
+
+        # Reject typos in path= before anything gets cloned. Anonymous users
+        # only get to find out which paths exist in public repos.
+        if is_git_request and (not is_redirect or all(
+                is_public_repo(repo) for repo, _ in groups)):
+            groups, _, missing = yield resolve_repo_groups(groups)
+            if missing:
+                self.set_status(404)
+                return self.render(
+                    'error.html',
+                    log='Not found: {}'.format(', '.join(missing)),
+                    link_retry=options.config['URL'])
+
         if is_redirect:
-            values = []
-            for k, v in args.items():
-                if not isinstance(v, str):
-                    v = '&path='.join(v)
-                values.append('%s=%s' % (k, v))
             util.logger.info("rendering landing page")
-            download_links = (util.generate_git_download_link(args)
-                              if is_git_request
-                              else [args['file']])
+            if is_git_request:
+                query = repo_groups_query(groups)
+                download_links = []
+                for repo, paths in groups:
+                    repo_args = {'repo': repo, 'path': paths}
+                    if is_public_repo(repo):
+                        download_links.append((
+                            util.generate_git_download_link(
+                                repo_args, options.config['URL']),
+                            repo))
+                    else:
+                        # The download endpoint would send anonymous users
+                        # to the hub login
+                        download_links.extend(
+                            (link, path.split('/')[-1]) for link, path in
+                            zip(util.generate_downgit_links(repo_args),
+                                paths))
+            else:
+                query = 'file=%s' % args['file']
+                download_links = [(args['file'],
+                                   args['file'].split('/')[-1])]
             return self.render(
                 'landing.html',
                 authenticate_link=redirection,
                 download_links=download_links,
-                query='&'.join(values))
+                query=query)
 
         util.logger.info("rendering progress page")
 
@@ -110,34 +308,370 @@ class RequestHandler(WebSocketHandler):
     @gen.coroutine
     @use_args(url_args)
     def open(self, username, args):
-        util.logger.info('({}) Websocket connected'.format(username))
-
         # We don't do validation since we assume that the LandingHandler did
         # it, so this isn't very secure.
         is_file_request = ('file' in args)
+        start = time.time()
+        trace_args = dict(args)
+
+        if not is_file_request:
+            try:
+                # The socket can be opened without going through
+                # LandingHandler, so repo and path may be missing
+                groups = parse_repo_groups(args.get('repo', []),
+                                           args.get('path', []),
+                                           options.config['MAX_REPO_GROUPS'])
+            except ValueError as e:
+                message = messages.error(str(e))
+                recorder.record(start, username, trace_args, False, message,
+                                {})
+                self._send(message)
+                return
+
+            groups, indexes, missing = yield resolve_repo_groups(groups)
+            if missing:
+                message = messages.error(
+                    'Not found: {}'.format(', '.join(missing)))
+                recorder.record(start, username, trace_args, False, message,
+                                {})
+                self._send(message)
+                return
+            args['groups'] = groups
+
+            # on_close has already run if the tab closed while resolving, so
+            # attaching now would start a job nobody is waiting for
+            if self.ws_connection is None:
+                util.logger.info('(%s) Websocket closed before the job '
+                                 'started', username)
+                return
+
+        # Another tab asking for the same content joins the running job
+        if is_file_request:
+            self.job_key = (username, 'file', args['file'])
+        else:
+            self.job_key = (username, tuple(
+                (repo, tuple(paths)) for repo, paths in args['groups']))
+        job, created = job_registry.attach(self.job_key, self)
+
+        # Correlates all the log records of this job, including the ones
+        # emitted on the worker thread.
+        log_extra = {'job_id': job.id, 'username': username}
+        util.logger.info('(%s) Websocket connected', username,
+                         extra=log_extra)
 
+        message = None
         try:
-            if is_file_request:
-                message = yield thread_pool.submit(
-                    download_file_and_redirect,
-                    username=username,
-                    file_url=args['file'],
-                    config=options.config,
-                )
+            if created:
+                if not is_file_request and indexes[0] is not None:
+                    # A single redirect, to the last path of the first repo
+                    _, first_paths = groups[0]
+                    args['redirect_url'] = tree_index.redirect_url(
+                        indexes[0], options.config, username, first_paths[-1])
+                job.future = self._submit_job(job, username, args)
             else:
-                message = yield thread_pool.submit(
-                    pull_from_github,
-                    username=username,
-                    repo_name=args['repo'],
-                    paths=args['path'],
-                    config=options.config,
-                    progress=Progress(username, self.write_message)
-                )
-
-            util.logger.info('Sent message: {}'.format(message))
-            self.write_message(message)
+                util.logger.info('(%s) Joined running job', username,
+                                 extra=log_extra)
+
+            message = yield job.future
+            util.logger.info('Sent message: %s', message, extra=log_extra)
+            self._send(message)
         except Exception as e:
             # If something bad happens, the client should see it
             message = messages.error(str(e))
-            util.logger.error('Sent message: {}'.format(message))
+            util.logger.error('Sent message: %s', message, extra=log_extra)
+            self._send(message)
+        finally:
+            recorder.record(start, username, trace_args, not created,
+                            message, dict(job.phases))
+            if created:
+                job_registry.finish(self.job_key, job)
+                profiler.job_finished()
+
+    def on_close(self):
+        # Cancels the job if nobody else is waiting for it
+        job_key = getattr(self, 'job_key', None)
+        if job_key is not None:
+            job_registry.detach(job_key, self)
+
+    def _submit_job(self, job, username, args):
+        """Starts the work for job on the thread pool and returns a future."""
+        # Imported here to keep GitPython off the startup path, see warmup.py
+        from .git_progress import Progress
+        from .pull_from_github import pull_from_github
+
+        if 'file' in args:
+            return thread_pool.submit(
+                util.in_job_context(job.id, username,
+                                    download_file_and_redirect, job.phases),
+                username=username,
+                file_url=args['file'],
+                config=options.config,
+                cancel_token=job.token,
+            )
+
+        progress = Progress(
+            username, job.broadcast,
+            log_interval=options.config['PROGRESS_LOG_INTERVAL_S'])
+        return thread_pool.submit(
+            util.in_job_context(job.id, username, pull_from_github,
+                                job.phases),
+            username=username,
+            groups=args['groups'],
+            config=options.config,
+            progress=progress,
+            cancel_token=job.token,
+            redirect_url=args.get('redirect_url'),
+            executor=thread_pool,
+        )
+
+    def _send(self, message):
+        try:
             self.write_message(message)
+        except WebSocketClosedError:
+            pass
+
+
+class ArchiveHandler(web.RequestHandler):
+    """
+    Streams a zip of paths in a repo, built by `git archive` from the
+    server-side mirror at the branch tip:
+
+        download?repo=textbook&path=notebooks&path=chapter1
+
+    The zip is written to the archive cache while it's streamed, so the next
+    download of the same paths at the same commit is served from disk. See
+    archive.py.
+
+    Repos outside PUBLIC_REPOS can only be downloaded by logged in users.
+    """
+    @gen.coroutine
+    @use_args(archive_args)
+    def get(self, args):
+        config = options.config
+        repo_name = args['repo']
+        if not mirror.is_valid_repo_name(repo_name) or not args['path']:
+            raise web.HTTPError(404)
+
+        if not is_public_repo(repo_name):
+            # authenticate() returns either a username or a login redirect
+            redirection = HubAuth(config).authenticate(self.request)
+            if redirection.startswith('/') or redirection.startswith('http'):
+                return self.redirect(redirection)
+
+        index = yield self._get_index(repo_name)
+        paths = [index.normalize(path) for path in args['path']]
+        if not all(paths):
+            index = yield refreshed_index(index)
+            paths = [index.normalize(path) for path in args['path']]
+        if not all(paths):
+            raise web.HTTPError(404)
+        paths = sorted(set(paths))
+
+        filename = (posixpath.basename(paths[0]) if len(paths) == 1
+                    else repo_name)
+        self.set_header('Content-Type', 'application/zip')
+        self.set_header('Content-Disposition',
+                        'attachment; filename="{}.zip"'.format(filename))
+
+        archive_file = archive.cache_path(config, repo_name, index.commit,
+                                          paths)
+        if os.path.exists(archive_file):
+            util.logger.info('Serving cached archive %s', archive_file)
+            yield self._stream_cached(archive_file)
+        else:
+            util.logger.info('Archiving %s at %s: %s', repo_name,
+                             index.commit[:7], ', '.join(paths))
+            yield self._stream_new(archive_file, repo_name, index.commit,
+                                   paths)
+
+    @gen.coroutine
+    def _get_index(self, repo_name):
+        """Tree index of repo_name, waiting for its mirror if necessary."""
+        config = options.config
+        index = yield index_pool.submit(tree_index.get_index, repo_name,
+                                        config)
+        if index is None:
+            # get_index has queued a refresh of the missing or stale mirror
+            try:
+                yield mirror.refresher.request_refresh(repo_name, config)
+            except Exception:
+                raise web.HTTPError(404)
+            index = yield index_pool.submit(tree_index.get_index, repo_name,
+                                            config)
+        if index is None:
+            raise web.HTTPError(404)
+        return index
+
+    @gen.coroutine
+    def _stream_cached(self, archive_file):
+        chunk_size = options.config['ARCHIVE_CHUNK_SIZE']
+        try:
+            # Marks the archive as recently used for prune_cache
+            os.utime(archive_file)
+            infile = open(archive_file, 'rb')
+        except OSError:
+            # Pruned in the meantime
+            raise web.HTTPError(404)
+
+        with infile:
+            size = os.fstat(infile.fileno()).st_size
+            self.set_header('Content-Length', size)
+            while True:
+                chunk = yield archive_pool.submit(archive.copy_chunk, infile,
+                                                  None, chunk_size)
+                if not chunk:
+                    break
+                self.write(chunk)
+                try:
+                    yield self.flush()
+                except StreamClosedError:
+                    return
+
+    @gen.coroutine
+    def _stream_new(self, archive_file, repo_name, commit, paths):
+        config = options.config
+        chunk_size = config['ARCHIVE_CHUNK_SIZE']
+        archive_dir = os.path.dirname(archive_file)
+        os.makedirs(archive_dir, exist_ok=True)
+
+        process = archive.start_archive(config, repo_name, commit, paths)
+        fd, tmp_file = tempfile.mkstemp(dir=archive_dir, prefix='.',
+                                        suffix='.tmp')
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as outfile:
+                while True:
+                    chunk = yield archive_pool.submit(
+                        archive.copy_chunk, process.stdout, outfile,
+                        chunk_size)
+                    if not chunk:
+                        break
+                    self.write(chunk)
+                    yield self.flush()
+
+            # Raises GitCommandError with git's stderr on failure
+            yield archive_pool.submit(process.wait)
+            os.rename(tmp_file, archive_file)
+            complete = True
+        except StreamClosedError:
+            util.logger.info('Client went away while archiving %s',
+                             repo_name)
+        finally:
+            if not complete:
+                process.proc.kill()
+                process.proc.wait()
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+        archive_pool.submit(archive.prune_cache, config)
+
+
+class ReadyHandler(web.RequestHandler):
+    """
+    Readiness probe for the load balancer: 503 until the warm-up of this
+    instance (see warmup.py) has finished without errors, then 200. The
+    details of the warm-up are in admin/status, since errors can contain repo
+    URLs.
+    """
+    def get(self):
+        ready = self.application.warmup.ready
+        if not ready:
+            self.set_status(503)
+        self.write({'ready': ready})
+
+
+class WebhookHandler(web.RequestHandler):
+    """
+    Github push webhook. Refreshes the mirror of the pushed repo in the
+    background so user pulls can fetch from it without going to Github.
+
+    The payload must be signed with WEBHOOK_SECRET (X-Hub-Signature-256).
+    See remote/send_push_hook.py for a local stand-in for Github.
+    """
+    def post(self):
+        secret = options.config['WEBHOOK_SECRET']
+        signature = self.request.headers.get('X-Hub-Signature-256', '')
+        expected = 'sha256=' + hmac.new(secret.encode('utf-8'),
+                                        self.request.body,
+                                        hashlib.sha256).hexdigest()
+        if not secret or not hmac.compare_digest(signature, expected):
+            raise web.HTTPError(403)
+
+        event = self.request.headers.get('X-GitHub-Event')
+        if event == 'ping':
+            return self.write({'status': 'pong'})
+        if event != 'push':
+            return self.write({'status': 'ignored'})
+
+        try:
+            payload = json.loads(self.request.body.decode('utf-8'))
+            repo_name = payload['repository']['name']
+            ref = payload['ref']
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPError(400, 'Malformed push payload')
+
+        if not mirror.is_valid_repo_name(repo_name):
+            raise web.HTTPError(400, 'Invalid repository name')
+        if ref != 'refs/heads/' + options.config['REPO_BRANCH']:
+            return self.write({'status': 'ignored'})
+
+        util.logger.info('Push to %s, refreshing mirror', repo_name)
+        mirror.refresher.request_refresh(repo_name, options.config)
+        self.set_status(202)
+        self.write({'status': 'refreshing'})
+
+
+class AdminHandler(web.RequestHandler):
+    """
+    Base class for operator endpoints. Requests must carry the ADMIN_TOKEN
+    from the config in an "Authorization: token <ADMIN_TOKEN>" header.
+    """
+    def prepare(self):
+        admin_token = options.config['ADMIN_TOKEN']
+        auth_header = self.request.headers.get('Authorization', '')
+        expected = 'token {}'.format(admin_token)
+        if not admin_token or not hmac.compare_digest(auth_header, expected):
+            raise web.HTTPError(403)
+
+
+class ProfileHandler(AdminHandler):
+    """
+    Controls the sampling profiler.
+
+        GET                          : profiler status
+        POST ?jobs=N&seconds=T       : profile the next N jobs or T seconds
+        DELETE                       : stop profiling and write the results
+    """
+    def get(self):
+        self.write(profiler.status())
+
+    @use_args(profile_args)
+    def post(self, args):
+        started = profiler.start(options.config,
+                                 jobs=args.get('jobs'),
+                                 seconds=args.get('seconds'))
+        if not started:
+            raise web.HTTPError(409, 'Profiler is already running')
+        self.write(profiler.status())
+
+    def delete(self):
+        profiler.stop()
+        self.write(profiler.status())
+
+
+class StatusHandler(AdminHandler):
+    """
+    Reports the current job concurrency limit, load and the recent
+    decisions of the adaptive controller; the repo handle pool; IOLoop lag
+    and the call sites that blocked the loop; and the warm-up steps.
+    """
+    def get(self):
+        self.write({
+            'jobs': thread_pool.status(),
+            'running_jobs': len(job_registry.jobs),
+            'repo_pool': repo_pool.pool.status(),
+            'ioloop': watchdog.status(),
+            'warmup': self.application.warmup.status(),
+        })
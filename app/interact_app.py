@@ -1,8 +1,15 @@
 import os
+import tornado.template
 import tornado.web
 from tornado.options import define
 
-from .handlers import LandingHandler, RequestHandler
+from . import util
+from .git_maintenance import MaintenanceScheduler
+from .handlers import (ArchiveHandler, LandingHandler, ProfileHandler,
+                       ReadyHandler, RequestHandler, StatusHandler,
+                       WebhookHandler, thread_pool)
+from .tracing import recorder
+from .warmup import Warmup
 
 
 class InteractApp(tornado.web.Application):
@@ -16,22 +23,39 @@ class InteractApp(tornado.web.Application):
         # TODO(sam): Replace with a better solution
         define('config', config)
 
+        util.configure_logging(config)
+        thread_pool.configure(config)
+        recorder.configure(config)
+
         # Assumes config['URL'] has a trailing slash
         base_url = config['URL']
         base_url_without_slash = base_url[:-1]
         socket_url = base_url + r'socket/(\S+)'
+        admin_url = base_url + 'admin/'
 
         handlers = [
             (base_url, LandingHandler),
             (base_url_without_slash, LandingHandler),
             (socket_url, RequestHandler),
+            (base_url + 'download', ArchiveHandler),
+            (base_url + 'ready', ReadyHandler),
+            (base_url + 'webhook', WebhookHandler),
+            (admin_url + 'profile', ProfileHandler),
+            (admin_url + 'status', StatusHandler),
         ]
 
+        template_path = os.path.join(os.path.dirname(__file__), 'templates')
+        # Shared with the warm-up, which compiles the templates ahead of the
+        # first request
+        template_loader = tornado.template.Loader(template_path)
+
         settings = dict(
-            debug=True,
-            serve_traceback=True,
-            compiled_template_cache=False,
-            template_path=os.path.join(os.path.dirname(__file__), 'templates'),
+            debug=config['DEBUG'],
+            serve_traceback=config['DEBUG'],
+            # Templates are recompiled on every render while developing
+            compiled_template_cache=not config['DEBUG'],
+            template_path=template_path,
+            template_loader=template_loader,
             static_path=os.path.join(os.path.dirname(__file__), 'static'),
 
             # Ensure static urls are prefixed with the base url too
@@ -39,3 +63,8 @@ class InteractApp(tornado.web.Application):
         )
 
         super(InteractApp, self).__init__(handlers, **settings)
+
+        # Started from run.py once the IOLoop exists
+        self.maintenance = MaintenanceScheduler(config)
+        # Started from run.py once the app is listening, see ReadyHandler
+        self.warmup = Warmup(config, template_loader)
@@ -0,0 +1,194 @@
+"""
+Cancellation and sharing of pull/download jobs.
+
+Each job gets a CancelToken that the worker checks between steps. Anything
+that can block for a long time (a git subprocess, an HTTP transfer) registers
+an abort callback on the token so that cancelling actually interrupts it.
+Jobs are cancelled when a phase runs past its timeout, or when the last
+websocket watching the job closes.
+
+Websockets asking for the same content for the same user share one Job so
+that reloading the tab doesn't start a second pull of the same repo.
+"""
+import os
+import signal
+import socket
+import threading
+from contextlib import contextmanager
+
+from . import util
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once its CancelToken has been cancelled."""
+
+
+class CancelToken(object):
+    """Thread-safe cancellation flag with abort callbacks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reason = None
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason):
+        """Cancels the job and runs all registered abort callbacks."""
+        with self.lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks = list(self.callbacks)
+
+        util.logger.info('Cancelling job: %s', reason)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                util.logger.warn('Abort callback failed: %s', e)
+
+    def check(self):
+        """Raises JobCancelled if the job has been cancelled."""
+        if self.reason is not None:
+            raise JobCancelled(self.reason)
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """
+        Runs callback if the job is cancelled while inside the block. If the
+        job was already cancelled the callback runs immediately.
+        """
+        with self.lock:
+            already_cancelled = self.reason is not None
+            if not already_cancelled:
+                self.callbacks.append(callback)
+        if already_cancelled:
+            callback()
+        try:
+            yield
+        finally:
+            with self.lock:
+                if callback in self.callbacks:
+                    self.callbacks.remove(callback)
+
+    @contextmanager
+    def phase(self, name, timeout):
+        """
+        Cancels the job if the block runs for more than timeout seconds, then
+        raises JobCancelled on exit if the job was cancelled.
+        """
+        timer = threading.Timer(
+            timeout, self.cancel,
+            ['{} timed out after {} seconds'.format(name, timeout)])
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+        self.check()
+
+
+def kill_process_group(process):
+    """
+    Abort callback for a subprocess started with start_new_session=True.
+    Kills the whole group so helpers like git-remote-https die too.
+    """
+    def kill():
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    return kill
+
+
+def shutdown_response(response):
+    """
+    Abort callback for an http.client response being read on another thread.
+    Shuts its socket down, which makes the blocked read return at once.
+    Closing the response instead would wait for that read to finish, on the
+    thread cancelling the job, which is usually the IOLoop's.
+    """
+    def shutdown():
+        try:
+            sock = response.fp.raw._sock
+        except AttributeError:
+            # Already closed
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    return shutdown
+
+
+class Job(object):
+    """
+    A running job and the websockets watching it.
+
+    Messages are broadcast to every attached client.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.id = util.new_job_id()
+        self.token = CancelToken()
+        self.clients = set()
+        self.future = None
+        # Phase name -> seconds, filled in by the worker (see util.log_phase)
+        self.phases = {}
+
+    def broadcast(self, message):
+        for client in list(self.clients):
+            try:
+                client.write_message(message)
+            except Exception as e:
+                util.logger.debug('Could not write to client: %s', e)
+
+
+class JobRegistry(object):
+    """
+    Running jobs by key. Only used from the IOLoop thread, so it needs no
+    locking.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+
+    def attach(self, key, client):
+        """
+        Attaches client to the running job for key, creating it if needed.
+        A job that was cancelled, eg. because the only tab watching it was
+        reloaded, is replaced by a new one rather than joined.
+
+        Returns (job, created).
+        """
+        job = self.jobs.get(key)
+        created = job is None or job.token.cancelled
+        if created:
+            job = self.jobs[key] = Job(key)
+        job.clients.add(client)
+        return job, created
+
+    def detach(self, key, client):
+        """
+        Detaches client from the job for key. Cancels the job if that was the
+        last client watching it.
+        """
+        job = self.jobs.get(key)
+        if job is None or client not in job.clients:
+            return
+        job.clients.discard(client)
+        if not job.clients:
+            job.token.cancel('All clients disconnected')
+
+    def finish(self, key, job):
+        """
+        Unregisters job once it's done, unless a newer job for key has
+        already replaced it.
+        """
+        if self.jobs.get(key) is job:
+            del self.jobs[key]
@@ -0,0 +1,203 @@
+"""
+Server-side mirrors of the upstream Github repos.
+
+A mirror is a bare `git clone --mirror` of an upstream repo kept under
+MIRROR_PATH. Mirrors are refreshed in the background whenever Github tells us
+about a push (see WebhookHandler), so user pulls can clone and fetch from the
+local mirror instead of going over the network.
+
+A mirror that hasn't been refreshed for MIRROR_MAX_AGE_S is considered stale;
+pulls then go to Github directly and a refresh is queued, so a repo without a
+webhook still gets updates. Without a webhook (no WEBHOOK_SECRET) nothing
+tells us about pushes, so the mirror is only used while its branch tip
+matches Github's, which `git ls-remote` checks cheaply.
+"""
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import util
+
+git = util.lazy_import('git')
+
+# Written into the mirror after every successful refresh
+STAMP_FILE = 'interact-refreshed'
+
+REPO_NAME_REGEX = re.compile(r'^[\w.-]+$')
+
+# One lock per repo so that two refreshes of the same mirror never overlap
+_locks = {}
+_locks_lock = threading.Lock()
+
+# repo_name -> (time.time() of the check, Github's branch tip)
+_remote_tips = {}
+
+
+def _repo_lock(repo_name):
+    with _locks_lock:
+        return _locks.setdefault(repo_name, threading.Lock())
+
+
+def is_valid_repo_name(repo_name):
+    """Only plain names, so a repo name can't escape MIRROR_PATH."""
+    return bool(REPO_NAME_REGEX.match(repo_name)) and repo_name not in ('.', '..')
+
+
+def mirror_dir(repo_name, config):
+    return os.path.join(config['MIRROR_PATH'], repo_name + '.git')
+
+
+def last_refreshed(repo_name, config):
+    """time.time() of the last successful refresh, or None."""
+    try:
+        return os.path.getmtime(
+            os.path.join(mirror_dir(repo_name, config), STAMP_FILE))
+    except OSError:
+        return None
+
+
+def local_source(repo_name, config):
+    """
+    Path of a fresh mirror for repo_name that pulls can use instead of
+    Github, or None if there is no usable mirror. Queues a refresh when the
+    mirror is missing or stale.
+    """
+    refreshed = last_refreshed(repo_name, config)
+    if refreshed is not None and \
+            time.time() - refreshed < config['MIRROR_MAX_AGE_S'] and \
+            (config['WEBHOOK_SECRET'] or _matches_remote(repo_name, config)):
+        return mirror_dir(repo_name, config)
+
+    refresher.request_refresh(repo_name, config)
+    return None
+
+
+def _matches_remote(repo_name, config):
+    """
+    Whether the mirror's branch tip is the same as Github's. Also true if
+    Github can't be reached, since pulls couldn't go there either.
+    """
+    remote = remote_tip(repo_name, config)
+    return remote is None or remote == branch_tip(repo_name, config)
+
+
+def remote_tip(repo_name, config):
+    """
+    Commit sha of REPO_BRANCH on Github, or None if it can't be reached.
+    Cached for MIRROR_TIP_CACHE_S so that the landing page and the pull of
+    one link check only once.
+    """
+    now = time.time()
+    with _locks_lock:
+        cached = _remote_tips.get(repo_name)
+    if cached is not None and now - cached[0] < config['MIRROR_TIP_CACHE_S']:
+        return cached[1]
+
+    try:
+        output = git.Git().ls_remote(
+            config['GITHUB_ORG'] + repo_name,
+            'refs/heads/' + config['REPO_BRANCH'],
+            kill_after_timeout=config['MIRROR_TIP_TIMEOUT_S'])
+    except git.exc.GitCommandError as git_err:
+        util.logger.warn('Could not check the branch tip of %s: %s',
+                         repo_name, git_err)
+        return None
+
+    tip = output.split()[0] if output else None
+    with _locks_lock:
+        _remote_tips[repo_name] = (now, tip)
+    return tip
+
+
+def branch_tip(repo_name, config):
+    """Commit sha of REPO_BRANCH in the mirror, or None without a mirror."""
+    if last_refreshed(repo_name, config) is None:
+        return None
+    try:
+        return git.Git(mirror_dir(repo_name, config)).rev_parse(
+            'refs/heads/' + config['REPO_BRANCH'])
+    except git.exc.GitCommandError:
+        return None
+
+
+def refresh_mirror(repo_name, config):
+    """
+    Creates or updates the mirror of repo_name from Github.
+
+    New mirrors are cloned into a temporary directory and moved into place,
+    so readers never see a half-written mirror.
+    """
+    directory = mirror_dir(repo_name, config)
+    url = config['GITHUB_ORG'] + repo_name
+
+    with _repo_lock(repo_name):
+        start = time.time()
+        if not os.path.exists(directory):
+            os.makedirs(config['MIRROR_PATH'], exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(dir=config['MIRROR_PATH'],
+                                       prefix='.' + repo_name + '-')
+            try:
+                git.Git().clone('--mirror', '--quiet', url, tmp_dir,
+                                kill_after_timeout=config['GIT_CLONE_TIMEOUT_S'])
+                os.rename(tmp_dir, directory)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            git.Git(directory).fetch(
+                '--prune', '--quiet', 'origin',
+                kill_after_timeout=config['GIT_FETCH_TIMEOUT_S'])
+
+        # Speeds up the merge-base and rev-list walks of user fetches
+        try:
+            git.Git(directory).commit_graph('write', '--reachable')
+        except git.exc.GitCommandError as git_err:
+            util.logger.warn('Could not write commit-graph for %s: %s',
+                             repo_name, git_err)
+
+        with open(os.path.join(directory, STAMP_FILE), 'w') as stamp:
+            stamp.write('{}\n'.format(time.time()))
+
+        util.logger.info('Refreshed mirror of %s in %.2fs',
+                         repo_name, time.time() - start)
+
+
+class MirrorRefresher(object):
+    """
+    Refreshes mirrors on a background thread.
+
+    Requests for a repo that already has a refresh queued are merged into
+    it; a request that arrives while the repo is being refreshed queues one
+    more refresh so that the push that triggered it is not missed.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.lock = threading.Lock()
+        self.queued = {}
+
+    def request_refresh(self, repo_name, config):
+        """Queues a refresh of repo_name and returns its future."""
+        with self.lock:
+            future = self.queued.get(repo_name)
+            if future is None:
+                future = self.queued[repo_name] = self.executor.submit(
+                    self._refresh, repo_name, config)
+            return future
+
+    def _refresh(self, repo_name, config):
+        # Later requests must queue a new refresh from here on
+        with self.lock:
+            self.queued.pop(repo_name, None)
+        try:
+            refresh_mirror(repo_name, config)
+        except (git.exc.GitCommandError, OSError) as e:
+            util.logger.error('Could not refresh mirror of %s: %s',
+                              repo_name, e)
+            raise
+
+
+refresher = MirrorRefresher()
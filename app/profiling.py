@@ -0,0 +1,164 @@
+"""
+On-demand sampling profiler for live workers.
+
+When switched on (see ProfileHandler) a background thread samples the stacks
+of every thread in the process, which covers both the IOLoop and the job
+pool workers, and tracemalloc records allocations. Profiling stops after the
+requested number of jobs finish or the requested time passes, and the results
+are written to PROFILE_PATH:
+
+- profile-<time>.folded: collapsed stacks, one "frame;frame;... count" line
+  per unique stack, ready for flamegraph.pl or speedscope
+- profile-<time>-memory.txt: the top allocation sites that grew while
+  profiling
+
+While switched off the only cost is a flag check when each job finishes.
+"""
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+
+from . import util
+
+
+class SamplingProfiler(object):
+    """Samples all thread stacks until a job count or deadline is reached."""
+
+    def __init__(self):
+        self.active = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.jobs_left = None
+        self.deadline = None
+        self.started_at = None
+        self.memory_start = None
+        self.config = None
+        self.last_output = []
+
+    def start(self, config, jobs=None, seconds=None):
+        """
+        Starts profiling until `jobs` more jobs finish or `seconds` pass,
+        whichever happens first. Seconds are capped at PROFILE_MAX_SECONDS.
+
+        Returns False if the profiler is already running.
+        """
+        max_seconds = config['PROFILE_MAX_SECONDS']
+        seconds = min(seconds or max_seconds, max_seconds)
+
+        with self.lock:
+            if self.active:
+                return False
+            self.active = True
+            self.config = config
+            self.stacks = Counter()
+            self.samples = 0
+            self.jobs_left = jobs
+            self.started_at = time.time()
+            self.deadline = self.started_at + seconds
+            self.stop_event.clear()
+
+        tracemalloc.start(config['PROFILE_TRACEMALLOC_FRAMES'])
+        self.memory_start = tracemalloc.take_snapshot()
+
+        self.thread = threading.Thread(target=self._sample_loop,
+                                       name='interact-profiler', daemon=True)
+        self.thread.start()
+        util.logger.info('Profiling started for %s jobs / %ss',
+                         jobs, seconds)
+        return True
+
+    def job_finished(self):
+        """Called whenever a pull or download job finishes."""
+        if not self.active:
+            return
+        with self.lock:
+            if self.jobs_left is None:
+                return
+            self.jobs_left -= 1
+            if self.jobs_left > 0:
+                return
+        self.stop_event.set()
+
+    def stop(self):
+        """Stops profiling early. The results are still written."""
+        self.stop_event.set()
+
+    def status(self):
+        with self.lock:
+            return {
+                'active': self.active,
+                'samples': self.samples,
+                'jobs_left': self.jobs_left,
+                'seconds_left': (max(self.deadline - time.time(), 0)
+                                 if self.active else None),
+                'last_output': self.last_output,
+            }
+
+    def _sample_loop(self):
+        interval = self.config['PROFILE_SAMPLE_INTERVAL_S']
+        own_ident = threading.get_ident()
+
+        while not self.stop_event.wait(interval):
+            if time.time() >= self.deadline:
+                break
+
+            names = {thread.ident: thread.name
+                     for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                self.stacks[_collapse(names.get(ident, ident), frame)] += 1
+            self.samples += 1
+
+        self._finish()
+
+    def _finish(self):
+        memory_end = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        path = self.config['PROFILE_PATH']
+        os.makedirs(path, exist_ok=True)
+        prefix = os.path.join(
+            path, 'profile-{}'.format(time.strftime('%Y%m%d-%H%M%S')))
+
+        with open(prefix + '.folded', 'w') as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write('{} {}\n'.format(stack, count))
+
+        stats = memory_end.compare_to(self.memory_start, 'traceback')
+        with open(prefix + '-memory.txt', 'w') as outfile:
+            for stat in stats[:self.config['PROFILE_TRACEMALLOC_TOP']]:
+                outfile.write('{}\n'.format(stat))
+                for line in stat.traceback.format():
+                    outfile.write('    {}\n'.format(line))
+
+        with self.lock:
+            self.active = False
+            self.jobs_left = None
+            self.last_output = [prefix + '.folded', prefix + '-memory.txt']
+            self.memory_start = None
+
+        util.logger.info('Profiling done: %s samples over %.1fs written to %s',
+                         self.samples, time.time() - self.started_at, prefix)
+
+
+def _collapse(thread_name, frame):
+    """Turns a frame into a root-first ;-separated stack string."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append('{} ({}:{})'.format(
+            code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+        frame = frame.f_back
+    frames.append(str(thread_name))
+    return ';'.join(reversed(frames))
+
+
+# Shared by the admin endpoint and the job handlers
+profiler = SamplingProfiler()
@@ -1,10 +1,17 @@
 import os
 import re
+import shutil
+import time
 
 import git
+from git.cmd import handle_process_output
 
 from . import util
 from . import messages
+from . import git_maintenance
+from . import mirror
+from . import repo_pool
+from .jobs import CancelToken, JobCancelled, kill_process_group
 
 
 def pull_from_github(**kwargs):
@@ -34,15 +41,30 @@ def pull_from_github(**kwargs):
             textbook or health-connector.
         paths (list of str): The folders and file names to pull.
         config (Config): The config for this environment.
+        progress (Progress): Receives git's progress output.
+        cancel_token (CancelToken): Optional. Cancelling it kills the running
+            git process and leaves the repo in a consistent state.
+        redirect_url (str): Optional. Where to redirect the user afterwards;
+            defaults to the last path under GIT_REDIRECT_PATH.
+        groups (list of (str, list of str)): Optional. (repo_name, paths)
+            pairs to pull concurrently instead of a single repo_name and
+            paths. See _pull_groups.
+        executor (AdaptiveExecutor): Optional. Runs the pulls of groups
+            concurrently within its job limit.
 
     Returns:
         A message object from messages.py
     """
+    if 'groups' in kwargs:
+        return _pull_groups(**kwargs)
+
     username = kwargs['username']
     repo_name = kwargs['repo_name']
     paths = kwargs['paths']
     config = kwargs['config']
     progress = kwargs['progress']
+    cancel_token = kwargs.get('cancel_token') or CancelToken()
+    redirect_url = kwargs.get('redirect_url')
 
     assert username and repo_name and paths and config
 
@@ -53,62 +75,239 @@ def pull_from_github(**kwargs):
 
     repo_dir = util.construct_path(config['COPY_PATH'], locals(), repo_name)
 
-    try:
-        if not os.path.exists(repo_dir):
-            _initialize_repo(
-                repo_name,
-                repo_dir,
-                config,
-                progress=progress,
-            )
-
-        _add_sparse_checkout_paths(repo_dir, paths)
-
-        repo = git.Repo(repo_dir)
-        _reset_deleted_files(repo)
-        _make_commit_if_dirty(repo)
-
-        _pull_and_resolve_conflicts(repo, config, progress=progress)
-
-        if not config['GIT_REDIRECT_PATH']:
-            return messages.status('Pulled from repo: ' + repo_name)
-
-        # Redirect to the final path given in the URL
-        destination = os.path.join(repo_name, paths[-1])
-        redirect_url = util.construct_path(config['GIT_REDIRECT_PATH'], {
-            'username': username,
-            'destination': destination,
-        })
-        util.logger.info('Redirecting to {}'.format(redirect_url))
-        return messages.redirect(redirect_url)
-
-    except git.exc.GitCommandError as git_err:
-        util.logger.error(git_err)
-        return messages.error(git_err.stderr.decode('UTF-8'))
-
-    finally:
-        # Always set ownership to username in case of a git failure
-        # In development, don't run the chown since the sample user doesn't
-        # exist on the system.
-        if config['MOCK_AUTH']:
-            util.logger.info("We're in development so we won't chown the dir.")
-        else:
-            util.chown_dir(repo_dir, username)
-
-
-def _initialize_repo(repo_name, repo_dir, config, progress=None):
+    # Clone and fetch from the server-side mirror when it's fresh
+    source = mirror.local_source(repo_name, config)
+
+    # Lock files older than this can't be left behind by our git processes
+    started_at = time.time()
+
+    with git_maintenance.repo_in_use(repo_dir):
+        try:
+            with git_maintenance.clone_lock(repo_dir):
+                if not os.path.exists(repo_dir):
+                    with util.log_phase('clone'), cancel_token.phase(
+                            'clone', config['GIT_CLONE_TIMEOUT_S']):
+                        _initialize_repo(
+                            repo_name,
+                            repo_dir,
+                            config,
+                            progress=progress,
+                            cancel_token=cancel_token,
+                            source=source,
+                        )
+
+            cancel_token.check()
+            with util.log_phase('sparse_checkout'):
+                _add_sparse_checkout_paths(repo_dir, paths)
+
+            with repo_pool.pool.repo(repo_dir, config) as repo:
+                with util.log_phase('reset_deleted'):
+                    _reset_deleted_files(repo)
+                with util.log_phase('commit'):
+                    _make_commit_if_dirty(repo)
+
+                cancel_token.check()
+                with util.log_phase('pull'):
+                    _pull_and_resolve_conflicts(repo, config,
+                                                progress=progress,
+                                                cancel_token=cancel_token,
+                                                source=source)
+
+            if not config['GIT_REDIRECT_PATH']:
+                return messages.status('Pulled from repo: ' + repo_name)
+
+            # Redirect to the final path given in the URL
+            if not redirect_url:
+                destination = os.path.join(repo_name, paths[-1])
+                redirect_url = util.construct_path(
+                    config['GIT_REDIRECT_PATH'], {
+                        'username': username,
+                        'destination': destination,
+                    })
+            util.logger.info('Redirecting to {}'.format(redirect_url))
+            return messages.redirect(redirect_url)
+
+        except git.exc.GitCommandError as git_err:
+            util.logger.error(git_err)
+            # git exited by itself, so it removed its locks
+            _restore_repo_state(repo_dir)
+            return messages.error(_git_error_message(git_err))
+
+        except JobCancelled as e:
+            util.logger.info('Pull cancelled: %s', e)
+            # Cancelling killed the running git process, if any
+            _restore_repo_state(repo_dir, started_at)
+            return messages.error('Pull cancelled: {}'.format(e))
+
+        finally:
+            # Always set ownership to username in case of a git failure
+            # In development, don't run the chown since the sample user doesn't
+            # exist on the system. A cancelled clone leaves no directory.
+            if not os.path.exists(repo_dir):
+                pass
+            elif config['MOCK_AUTH']:
+                util.logger.info("We're in development so we won't chown the dir.")
+            else:
+                with util.log_phase('chown'):
+                    util.chown_dir(repo_dir, username)
+
+
+def _pull_groups(**kwargs):
+    """
+    Pulls several repos, concurrently as far as the job limit of executor
+    allows. Each repo that can't get a job slot right away is pulled on the
+    calling thread instead, whose job already holds one, so the job never
+    waits for a slot while holding one.
+
+    Progress from all the pulls is merged into a single log, and the user is
+    redirected once: to redirect_url or the last path of the first repo.
+    """
+    groups = kwargs.pop('groups')
+    progress = kwargs.pop('progress')
+    redirect_url = kwargs.pop('redirect_url', None)
+    executor = kwargs.pop('executor', None)
+
+    if len(groups) == 1:
+        repo_name, paths = groups[0]
+        return pull_from_github(repo_name=repo_name, paths=paths,
+                                progress=progress, redirect_url=redirect_url,
+                                **kwargs)
+
+    def pull_group(i):
+        repo_name, paths = groups[i]
+        return pull_from_github(
+            repo_name=repo_name,
+            paths=paths,
+            progress=progress.child(repo_name) if progress else None,
+            redirect_url=redirect_url if i == 0 else None,
+            **kwargs)
+
+    futures = {}
+    if executor is not None:
+        for i in range(1, len(groups)):
+            future = executor.try_submit(
+                util.propagate_job_context(pull_group), i)
+            if future is not None:
+                futures[i] = future
+
+    results = [None] * len(groups)
+    for i in range(len(groups)):
+        if i not in futures:
+            results[i] = pull_group(i)
+    for i, future in futures.items():
+        results[i] = future.result()
+
+    errors = [message['payload'] for message in results
+              if message['type'] == messages.TYPES['error']]
+    if errors:
+        return messages.error('\n'.join(errors))
+
+    # The first repo's redirect (or status)
+    return results[0]
+
+
+PROGRESS_LINE_REGEX = re.compile(
+    r"(remote: )?[\w ]+:\s+\d+%"  # eg. "Receiving objects:  45% (9/20)"
+)
+
+
+def _run_cancellable_git(git_cli, args, progress=None, cancel_token=None):
+    """
+    Runs a long-running git command (clone, fetch) that reports progress.
+
+    Unlike the GitPython helpers, this keeps hold of the git process so that
+    cancelling cancel_token kills it along with any helper processes it
+    spawned.
+    """
+    progress = progress or git.RemoteProgress()
+    cancel_token = cancel_token or CancelToken()
+    command = ['git'] + args
+
+    # What git said apart from progress, for the error message
+    output = []
+    handle_progress = progress.new_message_handler()
+
+    def handle_stderr(line):
+        if not PROGRESS_LINE_REGEX.match(line):
+            output.append(line.rstrip())
+        handle_progress(line)
+
+    process = git_cli.execute(
+        command,
+        as_process=True,
+        # Own process group, so we can kill git-remote-https etc. as well
+        start_new_session=True,
+    )
+    with cancel_token.on_cancel(kill_process_group(process.proc)):
+        handle_process_output(process, None, handle_stderr,
+                              _wait_for_process)
+
+    cancel_token.check()
+    status = process.proc.returncode
+    if status != 0:
+        errors = [line for line in output
+                  if line.startswith(('error:', 'fatal:'))]
+        stderr = '\n'.join(errors or output)
+        raise git.exc.GitCommandError(command, status,
+                                      stderr.encode('utf-8'))
+
+
+def _wait_for_process(process):
+    return process.proc.wait()
+
+
+GIT_ERROR_STDERR_REGEX = re.compile(r"\s*stderr: '(.*)'$", re.DOTALL)
+
+
+def _git_error_message(git_err):
+    """
+    git's stderr from git_err. GitPython 2 keeps it as bytes, later versions
+    decode it and wrap it in "stderr: '...'".
+    """
+    stderr = git_err.stderr or b''
+    if isinstance(stderr, bytes):
+        return stderr.decode('utf-8', 'replace').strip()
+    match = GIT_ERROR_STDERR_REGEX.match(stderr)
+    return (match.group(1) if match else stderr).strip()
+
+
+def _initialize_repo(repo_name, repo_dir, config, progress=None,
+                     cancel_token=None, source=None):
     """
     Clones repository and configures it to use sparse checkout.
     Extraneous folders will get removed later using git read-tree
+
+    If source is given (a local mirror) the clone is made from it, copying
+    rather than hardlinking its objects, and origin is pointed back at Github
+    afterwards.
+
+    A clone that fails or gets cancelled is removed so that the next pull
+    starts from scratch.
     """
     util.logger.info('Repo {} doesn\'t exist. Cloning...'.format(repo_name))
+    url = config['GITHUB_ORG'] + repo_name
+
+    clone_args = ['clone', '--progress', '--branch', config['REPO_BRANCH']]
+    if source:
+        # A local clone would hardlink the mirror's packs into the user's
+        # repo, and chown_dir would then hand them to the user
+        clone_args.append('--no-hardlinks')
+
     # Clone repo
-    repo = git.Repo.clone_from(
-        config['GITHUB_ORG'] + repo_name,
-        repo_dir,
-        progress,
-        branch=config['REPO_BRANCH'],
-    )
+    try:
+        _run_cancellable_git(
+            git.Git(),
+            clone_args + [source or url, repo_dir],
+            progress=progress,
+            cancel_token=cancel_token,
+        )
+    except (git.exc.GitCommandError, JobCancelled):
+        shutil.rmtree(repo_dir, ignore_errors=True)
+        raise
+    repo = git.Repo(repo_dir)
+
+    if source:
+        repo.git.remote('set-url', 'origin', url)
 
     # Use sparse checkout
     config = repo.config_writer()
@@ -195,19 +394,109 @@ def _make_commit_if_dirty(repo):
         util.logger.info('Made WIP commit')
 
 
-def _pull_and_resolve_conflicts(repo, config, progress=None):
+def _pull_and_resolve_conflicts(repo, config, progress=None,
+                                cancel_token=None, source=None):
     """
     Git pulls, resolving conflicts with -Xours
+
+    If source is given (a local mirror) the branch is fetched from it into
+    origin's tracking branch instead of going to Github.
     """
-    util.logger.info('Starting pull from {}'.format(repo.remotes['origin']))
+    util.logger.info('Starting pull from {}'.format(source or 'origin'))
 
     git_cli = repo.git
+    cancel_token = cancel_token or CancelToken()
+    local_timeout = config['GIT_LOCAL_TIMEOUT_S']
+    branch = config['REPO_BRANCH']
+
+    if source:
+        fetch_args = ['fetch', '--progress', source,
+                      '+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch)]
+    else:
+        fetch_args = ['fetch', '--progress', 'origin']
 
     # Fetch then merge, resolving conflicts by keeping original content
-    repo.remote(name='origin').fetch(progress=progress)
-    git_cli.merge('-Xours', 'origin/' + config['REPO_BRANCH'])
+    with cancel_token.phase('fetch', config['GIT_FETCH_TIMEOUT_S']):
+        _run_cancellable_git(git_cli, fetch_args,
+                             progress=progress, cancel_token=cancel_token)
+    if _is_merged(repo, 'origin/' + branch):
+        util.logger.info('Already up to date with origin/' + branch)
+    else:
+        with cancel_token.phase('merge', local_timeout):
+            _run_cancellable_git(
+                git_cli, ['merge', '-Xours', 'origin/' + branch],
+                cancel_token=cancel_token)
 
     # Ensure only files/folders in sparse-checkout are left
-    git_cli.read_tree('-mu', 'HEAD')
+    with cancel_token.phase('read-tree', local_timeout):
+        _run_cancellable_git(git_cli, ['read-tree', '-mu', 'HEAD'],
+                             cancel_token=cancel_token)
+
+    util.logger.info('Pulled from {}'.format(source or 'origin'))
+
 
-    util.logger.info('Pulled from {}'.format(repo.remotes['origin']))
+def _is_merged(repo, ref):
+    """
+    Whether ref is HEAD or one of its parents, ie. the previous pull merged
+    it and nothing changed upstream since. A cheap check that reads the
+    commit through the repo's persistent cat-file process, so that no-op
+    pulls skip starting `git merge`.
+    """
+    try:
+        ref_sha = repo.commit(ref).hexsha
+        head = repo.head.commit
+    except (ValueError, git.exc.BadName):
+        return False
+    except TypeError:
+        # GitPython 2 can't read the packed-refs header of git >= 2.19;
+        # let git merge decide
+        return False
+    return ref_sha == head.hexsha or \
+        any(parent.hexsha == ref_sha for parent in head.parents)
+
+
+def _remove_locks(git_dir, since):
+    """Removes the lock files under git_dir modified since since."""
+    # Allow for filesystems with 1 second timestamps
+    since -= 1
+    for root, dirs, files in os.walk(git_dir):
+        if root == git_dir and 'objects' in dirs:
+            dirs.remove('objects')
+        for filename in files:
+            if not filename.endswith('.lock'):
+                continue
+            path = os.path.join(root, filename)
+            try:
+                if os.path.getmtime(path) >= since:
+                    os.remove(path)
+                    util.logger.info('Removed stale lock {}'.format(path))
+            except OSError:
+                pass
+
+
+def _restore_repo_state(repo_dir, killed_since=None):
+    """
+    Leaves the repo usable after a failed or cancelled pull by aborting a
+    half-done merge and, if we killed a git process that started after
+    killed_since, removing the lock files it left behind.
+
+    Only locks written since killed_since are removed, since the user may be
+    running git in the repo themselves. Skipped if another job is running on
+    the same repo, since its locks are still live.
+    """
+    git_dir = os.path.join(repo_dir, '.git')
+    if not os.path.isdir(git_dir):
+        return
+    if git_maintenance.repo_use_count(repo_dir) > 1:
+        util.logger.info('Other jobs on {}, not cleaning up'.format(repo_dir))
+        return
+
+    if killed_since is not None:
+        _remove_locks(git_dir, killed_since)
+
+    if os.path.exists(os.path.join(git_dir, 'MERGE_HEAD')):
+        try:
+            git.Repo(repo_dir).git.merge('--abort')
+            util.logger.info('Aborted interrupted merge in {}'.format(repo_dir))
+        except git.exc.GitCommandError as git_err:
+            util.logger.error(git_err)
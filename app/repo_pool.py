@@ -0,0 +1,129 @@
+"""
+Pool of git.Repo handles for the user repos we pull into.
+
+A git.Repo keeps long-lived `git cat-file --batch` processes for reading
+objects, so reusing one across consecutive pulls of the same user repo saves
+starting them, and locating and parsing the repo, on every pull.
+
+Handles are leased to one job at a time: a second job on the same repo while
+the first is running gets a fresh handle. The pool holds at most
+REPO_POOL_SIZE idle handles and evicts the least recently used one beyond
+that. A handle is dropped instead of reused when its repo changed on disk
+since it was returned (see _signature), eg. when the user deleted and
+re-cloned it or maintenance repacked it, and when the job using it failed.
+"""
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import util
+
+git = util.lazy_import('git')
+
+# Files under .git whose changes invalidate a pooled handle. The .git
+# directory itself catches the repo being deleted and cloned again.
+SIGNATURE_PATHS = ['', 'HEAD', 'index', 'packed-refs', 'config',
+                   os.path.join('objects', 'pack')]
+
+
+def _signature(repo_dir):
+    """Stat signature of the parts of repo_dir a git.Repo depends on."""
+    git_dir = os.path.join(repo_dir, '.git')
+    signature = []
+    for path in SIGNATURE_PATHS:
+        try:
+            stat = os.stat(os.path.join(git_dir, path))
+            signature.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _close(repo):
+    """Stops the helper processes of repo."""
+    try:
+        if hasattr(repo, 'close'):
+            repo.close()
+        else:
+            # Older GitPython without Repo.close
+            repo.git.clear_cache()
+    except Exception as e:
+        util.logger.warn('Could not close repo handle: %s', e)
+
+
+class RepoPool(object):
+    """LRU pool of idle git.Repo handles keyed by repo directory."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # repo_dir -> (repo, signature when it was returned)
+        self.idle = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidated': 0,
+                      'evicted': 0}
+
+    @contextmanager
+    def repo(self, repo_dir, config):
+        """
+        Leases a git.Repo for repo_dir, which must exist, for the duration of
+        the block.
+        """
+        repo = self._acquire(repo_dir)
+        try:
+            yield repo
+        except BaseException:
+            # The repo may be mid-merge or the helpers killed; start over
+            _close(repo)
+            raise
+        self._release(repo_dir, repo, config['REPO_POOL_SIZE'])
+
+    def _acquire(self, repo_dir):
+        with self.lock:
+            entry = self.idle.pop(repo_dir, None)
+
+        if entry is not None:
+            repo, signature = entry
+            if signature == _signature(repo_dir):
+                with self.lock:
+                    self.stats['hits'] += 1
+                return repo
+            util.logger.debug('%s changed on disk, dropping its handle',
+                              repo_dir)
+            _close(repo)
+            with self.lock:
+                self.stats['invalidated'] += 1
+
+        with self.lock:
+            self.stats['misses'] += 1
+        return git.Repo(repo_dir)
+
+    def _release(self, repo_dir, repo, size):
+        signature = _signature(repo_dir)
+        evicted = []
+        with self.lock:
+            if repo_dir in self.idle or size <= 0:
+                # Another job returned a handle for the same repo first
+                evicted.append(repo)
+            else:
+                self.idle[repo_dir] = (repo, signature)
+                while len(self.idle) > size:
+                    _, (old_repo, _) = self.idle.popitem(last=False)
+                    evicted.append(old_repo)
+                    self.stats['evicted'] += 1
+
+        for old_repo in evicted:
+            _close(old_repo)
+
+    def discard(self, repo_dir):
+        """Closes the idle handle of repo_dir, if any."""
+        with self.lock:
+            entry = self.idle.pop(repo_dir, None)
+        if entry is not None:
+            _close(entry[0])
+
+    def status(self):
+        with self.lock:
+            return dict(self.stats, idle=len(self.idle))
+
+
+pool = RepoPool()
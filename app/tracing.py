@@ -0,0 +1,94 @@
+"""
+Anonymized request traces, for replaying real traffic against a local
+instance (see benchmarks/replay.py).
+
+With TRACE_ENABLED, every websocket request is appended to TRACE_PATH as one
+line of JSON once it has been answered:
+
+    {"time": 1476912000.5, "user": "9f86d081884c7d65",
+     "args": {"repo": ["textbook"], "path": ["notebooks"]},
+     "joined": false, "result": "REDIRECT", "latency_s": 4.21,
+     "phases": {"clone": 3.02, "sparse_checkout": 0.01, ...}}
+
+Usernames are replaced by a salted hash, so traces show repeat users without
+identifying them. Lines are written on a background thread.
+"""
+import atexit
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+
+from . import util
+
+
+class TraceRecorder(object):
+    """Appends trace entries to TRACE_PATH when tracing is enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.salt = None
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def configure(self, config):
+        self.enabled = config['TRACE_ENABLED']
+        if not self.enabled:
+            return
+
+        self.salt = config['TRACE_SALT']
+        if not self.salt:
+            util.logger.warn('TRACE_SALT is not set, user hashes will not '
+                             'match across restarts')
+            self.salt = os.urandom(16).hex()
+
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._write_entries, args=(config['TRACE_PATH'],),
+                name='trace-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self._stop)
+        util.logger.info('Recording request traces to %s',
+                         config['TRACE_PATH'])
+
+    def user_hash(self, username):
+        return hmac.new(self.salt.encode('utf-8'), username.encode('utf-8'),
+                        hashlib.sha256).hexdigest()[:16]
+
+    def record(self, start, username, args, joined, message, phases):
+        """
+        Queues the trace entry of a request that started at time.time()
+        start and was answered with message.
+        """
+        if not self.enabled:
+            return
+        self.queue.put({
+            'time': start,
+            'user': self.user_hash(username),
+            'args': {key: args[key] for key in ('file', 'repo', 'path')
+                     if key in args},
+            'joined': joined,
+            'result': message['type'] if message else None,
+            'latency_s': time.time() - start,
+            'phases': phases,
+        })
+
+    def _write_entries(self, path):
+        with open(path, 'a') as outfile:
+            while True:
+                entry = self.queue.get()
+                if entry is None:
+                    return
+                outfile.write(json.dumps(entry, sort_keys=True) + '\n')
+                if self.queue.empty():
+                    outfile.flush()
+
+    def _stop(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+
+recorder = TraceRecorder()
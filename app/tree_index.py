@@ -0,0 +1,114 @@
+"""
+Index of the paths in an upstream repo's tree at a given commit.
+
+Built from the server-side mirror (see mirror.py) once per (repo, commit) and
+kept in a small LRU cache, so the LandingHandler can check the paths of an
+interact link, tell files from directories and work out where to redirect
+without cloning anything into a user's directory.
+"""
+import posixpath
+import threading
+from collections import OrderedDict
+
+from . import mirror
+from . import util
+
+git = util.lazy_import('git')
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class TreeIndex(object):
+    """The files and directories of a repo's tree at one commit."""
+
+    def __init__(self, repo_name, commit, files, dirs):
+        self.repo_name = repo_name
+        self.commit = commit
+        self.files = files
+        self.dirs = dirs
+
+    def normalize(self, path):
+        """
+        Returns the canonical form of path (no leading/trailing slashes, no
+        ./ or duplicate slashes) if it exists in the tree, otherwise None.
+        """
+        path = posixpath.normpath('/' + path.strip()).lstrip('/')
+        if path in self.files or path in self.dirs:
+            return path
+        return None
+
+    def is_dir(self, path):
+        return path in self.dirs
+
+
+def _build(repo_name, commit, config):
+    output = git.Git(mirror.mirror_dir(repo_name, config)).ls_tree(
+        '-r', '-t', '-z', '--full-tree', commit)
+
+    files, dirs = set(), set()
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        object_type = info.split()[1]
+        if object_type == 'blob':
+            files.add(path)
+        else:
+            # trees, and submodules which show up as commits
+            dirs.add(path)
+
+    util.logger.info('Built tree index of %s at %s: %d files, %d dirs',
+                     repo_name, commit[:7], len(files), len(dirs))
+    return TreeIndex(repo_name, commit, frozenset(files), frozenset(dirs))
+
+
+def get_index(repo_name, config):
+    """
+    Returns the TreeIndex of REPO_BRANCH's tip for repo_name, or None if
+    there is no fresh mirror to build it from (a refresh is queued then).
+
+    Runs git, so call it off the IOLoop.
+    """
+    if not mirror.is_valid_repo_name(repo_name):
+        return None
+    if mirror.local_source(repo_name, config) is None:
+        return None
+
+    commit = mirror.branch_tip(repo_name, config)
+    if commit is None:
+        return None
+
+    key = (repo_name, commit)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    index = _build(repo_name, commit, config)
+
+    with _cache_lock:
+        _cache[key] = index
+        while len(_cache) > config['TREE_INDEX_CACHE_SIZE']:
+            _cache.popitem(last=False)
+    return index
+
+
+def redirect_url(index, config, username, path):
+    """
+    Where to send the user after pulling path, which must be normalized.
+
+    Notebooks are opened directly with FILE_REDIRECT_PATH; directories and
+    other files go through GIT_REDIRECT_PATH. Returns None if that isn't
+    set, as in development.
+    """
+    destination = posixpath.join(index.repo_name, path)
+    is_notebook = path in index.files and path.endswith('.ipynb')
+    redirect_path = (config['FILE_REDIRECT_PATH'] if is_notebook
+                     else config['GIT_REDIRECT_PATH'])
+    if not redirect_path:
+        return None
+    return util.construct_path(redirect_path, {
+        'username': username,
+        'destination': destination,
+    })
@@ -1,9 +1,21 @@
 import os
+import json
+import atexit
+import time
+import importlib
+import uuid
+import queue
 import shutil
 import logging
+import threading
+import logging.handlers
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlencode
 
 """
-Format for downloading zip files of Git folders
+Format for downloading zip files of Git folders through DownGit, for repos
+the download endpoint only serves to logged in users
 
 :param repo: the repository name, from the Data8 organization on Github
 :param path: path to the desired file or folder
@@ -12,14 +24,189 @@ GIT_DOWNLOAD_LINK_FORMAT = 'https://minhaskamal.github.io/DownGit/#/home?url' \
                            '=http://github.com/data-8/{repo}/tree/gh-pages/{' \
                            'path}'
 
-
-# Log all messages by default
+# Log all messages by default. This is replaced by the queue-based pipeline
+# once configure_logging() is called with the environment's config.
 logging.basicConfig(
     format='[%(asctime)s]: %(levelname)s -- %(message)s',
     datefmt='%m/%d/%Y %I:%M:%S %p',
     level=logging.DEBUG)
 logger = logging.getLogger('app')
 
+# Per-thread job information (job id, username, phase timings) that gets
+# attached to every log record emitted while a job runs on a worker thread.
+_job = threading.local()
+
+_log_listener = None
+
+
+class JobContextFilter(logging.Filter):
+    """Adds job_id and username of the current job to log records."""
+
+    def filter(self, record):
+        if not hasattr(record, 'job_id'):
+            record.job_id = getattr(_job, 'job_id', None)
+        if not hasattr(record, 'username'):
+            record.username = getattr(_job, 'username', None)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as a single line of JSON."""
+
+    # Attributes every LogRecord has; anything else came from `extra`
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+        'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves all formatting to the listener thread.
+
+    The stock handler formats the message on the calling thread so records
+    can be pickled; ours never leave the process so that isn't needed.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(config):
+    """
+    Routes all logging through a queue so that formatting and writing JSON
+    records to stderr happens on a background thread instead of the IOLoop
+    or the job workers.
+    """
+    global _log_listener
+
+    if _log_listener is None:
+        # Flush whatever is still queued on shutdown
+        atexit.register(_stop_log_listener)
+    else:
+        _log_listener.stop()
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(-1)
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(JobContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(config['LOG_LEVEL'])
+
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+
+
+def _stop_log_listener():
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+def new_job_id():
+    """Short random id used to correlate the log records of one job."""
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def job_context(job_id, username, phases=None):
+    """
+    Tags all log records emitted by this thread with the given job. Phase
+    timings are recorded into phases if given.
+    """
+    _job.job_id = job_id
+    _job.username = username
+    _job.phases = {} if phases is None else phases
+    try:
+        yield
+    finally:
+        _job.job_id = _job.username = _job.phases = None
+
+
+def in_job_context(job_id, username, func, phases=None):
+    """Wraps func so that it runs inside job_context on whichever thread."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with job_context(job_id, username, phases):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def propagate_job_context(func):
+    """
+    Wraps func so that it runs in the current thread's job context when
+    called from another thread, eg. for the sub-tasks of a job.
+    """
+    job_id = getattr(_job, 'job_id', None)
+    username = getattr(_job, 'username', None)
+    phases = getattr(_job, 'phases', None)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # Shares phase timings with the parent job
+        with job_context(job_id, username, phases):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def job_phases():
+    """Phase name -> duration in seconds for the current thread's job."""
+    return dict(getattr(_job, 'phases', None) or {})
+
+
+@contextmanager
+def log_phase(phase):
+    """Times the enclosed block and logs its duration as a job phase."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - start
+        phases = getattr(_job, 'phases', None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + duration
+        logger.debug('Phase %s took %.3fs', phase, duration,
+                     extra={'phase': phase, 'duration_s': duration})
+
+
+class LazyModule(object):
+    """Module proxy that imports the module on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    """
+    Defers importing a heavy module, eg. GitPython, until it's used so that
+    it stays off the startup path. See warmup.py, which imports it early in
+    the background.
+    """
+    return LazyModule(name)
+
 
 def chown(path, filename):
     """Set owner and group of file to that of the parent directory."""
@@ -41,12 +228,27 @@ def construct_path(path, format, *args):
     return os.path.join(path.format(**format), *args)
 
 
-def generate_git_download_link(args):
-    """Generates a download link for files hosted on Git.
+def generate_downgit_links(args):
+    """Generates DownGit download links for files hosted on Git.
 
     :param args: dictionary of query string "arguments"
-    :return: URIs for the specified git resources
+    :return: URIs for the specified git resources, one per path
     """
     return [GIT_DOWNLOAD_LINK_FORMAT.format(
         repo=args['repo'],
         path=path) for path in args['path']]
+
+
+def generate_git_download_link(args, base_url):
+    """Generates a link to a zip of files hosted on Git.
+
+    The zip is built by the download endpoint (ArchiveHandler) from our
+    mirror of the repo.
+
+    :param args: dictionary of query string "arguments"
+    :param base_url: URL the app is served under, with a trailing slash
+    :return: URI of a zip of all the specified git resources
+    """
+    query = [('repo', args['repo'])] + [('path', path)
+                                        for path in args['path']]
+    return '{}download?{}'.format(base_url, urlencode(query))
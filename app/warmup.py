@@ -0,0 +1,187 @@
+"""
+Warm-up of a freshly started instance.
+
+A new process starts with no mirrors, empty caches, uncompiled templates and
+no connection to the hub, so without a warm-up the first students sent to a
+new instance during a lab spike would pay for all of it. Once the app is
+listening, Warmup runs these steps in the background:
+
+- modules   : imports GitPython and the pull code, which are kept off the
+              startup path (see util.lazy_import)
+- templates : compiles every template into the app's template loader
+- hub       : opens HUB_POOL_SIZE pooled connections to the hub (see
+              auth.hub_session) and checks that it accepts our API token
+- repo:NAME : refreshes the mirror and builds the tree index of each repo in
+              HOT_REPOS
+
+The instance reports ready (see ReadyHandler) once every step has finished
+successfully. A failed step, or a warm-up still running after
+WARMUP_TIMEOUT_S, keeps it out of the load balancer so that the problem is
+noticed instead of students running into it; set WARMUP_READY_ON_FAILURE to
+report ready anyway.
+
+Failed steps are retried in the background, first after WARMUP_RETRY_MIN_S
+and then doubling up to WARMUP_RETRY_MAX_S, so that an instance that started
+during a Github or hub outage becomes ready once it is over.
+"""
+import importlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import mirror
+from . import tree_index
+from . import util
+from .auth import HubAuth
+
+# Modules that are imported lazily on the request path, relative to app
+DEFERRED_MODULES = ['git', '.git_progress', '.pull_from_github']
+
+
+class Warmup(object):
+    """Runs the warm-up steps and tracks whether they have finished."""
+
+    def __init__(self, config, template_loader):
+        self.config = config
+        self.template_loader = template_loader
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.finished_at = None
+        self.timed_out = False
+        self.steps = {}
+        self.retry_in_s = None
+
+    @property
+    def failed(self):
+        """Names of the steps that failed so far."""
+        with self.lock:
+            return sorted(name for name, step in self.steps.items()
+                          if step['error'] is not None)
+
+    @property
+    def ready(self):
+        if self.config['WARMUP_READY_ON_FAILURE']:
+            return self.finished_at is not None or self.timed_out
+        return self.finished_at is not None and not self.failed
+
+    def start(self):
+        """Starts warming up on background threads."""
+        self.started_at = time.time()
+
+        timer = threading.Timer(self.config['WARMUP_TIMEOUT_S'],
+                                self._time_out)
+        timer.daemon = True
+        timer.start()
+
+        threading.Thread(target=self._run, name='interact-warmup',
+                         daemon=True).start()
+
+    def _run(self):
+        steps = [
+            ('modules', self._import_modules),
+            ('templates', self._compile_templates),
+            ('hub', self._connect_hub),
+        ]
+        steps += [('repo:' + repo_name, self._warm_repo, repo_name)
+                  for repo_name in self.config['HOT_REPOS']]
+
+        self._run_steps(steps)
+
+        self.finished_at = time.time()
+        failed = self.failed
+        if failed:
+            util.logger.error('Warm-up finished in %.2fs, failed steps: %s',
+                              self.finished_at - self.started_at,
+                              ', '.join(failed))
+            self._retry(steps)
+        else:
+            util.logger.info('Warm-up finished in %.2fs',
+                             self.finished_at - self.started_at)
+
+    def _run_steps(self, steps):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for step in steps:
+                executor.submit(self._run_step, *step)
+
+    def _retry(self, steps):
+        """Retries the failed steps, backing off, until they all pass."""
+        delay = self.config['WARMUP_RETRY_MIN_S']
+        failed = self.failed
+        while failed:
+            util.logger.info('Retrying warm-up steps %s in %ss',
+                             ', '.join(failed), delay)
+            self.retry_in_s = delay
+            time.sleep(delay)
+            self._run_steps([step for step in steps if step[0] in failed])
+            delay = min(delay * 2, self.config['WARMUP_RETRY_MAX_S'])
+            failed = self.failed
+
+        self.retry_in_s = None
+        util.logger.info('Warm-up steps passed after retrying, %.2fs since '
+                         'start', time.time() - self.started_at)
+
+    def _run_step(self, name, func, *args):
+        start = time.time()
+        with self.lock:
+            attempts = self.steps.get(name, {}).get('attempts', 0) + 1
+        try:
+            result = func(*args)
+            error = None
+        except Exception as e:
+            util.logger.warn('Warm-up step %s failed: %s', name, e)
+            result, error = None, str(e)
+
+        with self.lock:
+            self.steps[name] = {
+                'duration_s': time.time() - start,
+                'result': result,
+                'error': error,
+                'attempts': attempts,
+            }
+
+    def _time_out(self):
+        if self.finished_at is None:
+            util.logger.warn('Warm-up still running after %ss',
+                             self.config['WARMUP_TIMEOUT_S'])
+            self.timed_out = True
+
+    def _import_modules(self):
+        for name in DEFERRED_MODULES:
+            importlib.import_module(name, __package__)
+
+    def _compile_templates(self):
+        names = sorted(name for name in os.listdir(self.template_loader.root)
+                       if name.endswith('.html'))
+        for name in names:
+            self.template_loader.load(name)
+        return names
+
+    def _connect_hub(self):
+        return HubAuth(self.config).warm_up()
+
+    def _warm_repo(self, repo_name):
+        config = self.config
+        if mirror.local_source(repo_name, config) is None:
+            # local_source has queued the refresh, wait for it
+            mirror.refresher.request_refresh(repo_name, config).result(
+                timeout=config['WARMUP_TIMEOUT_S'])
+
+        index = tree_index.get_index(repo_name, config)
+        if index is None:
+            raise RuntimeError('No mirror of {}'.format(repo_name))
+        return index.commit
+
+    def status(self):
+        with self.lock:
+            steps = dict(self.steps)
+        return {
+            'ready': self.ready,
+            'timed_out': self.timed_out,
+            'retry_in_s': self.retry_in_s,
+            'failed': sorted(name for name, step in steps.items()
+                             if step['error'] is not None),
+            'warmup_s': ((self.finished_at or time.time()) - self.started_at
+                         if self.started_at else None),
+            'steps': steps,
+        }
@@ -0,0 +1,161 @@
+"""
+IOLoop lag watchdog.
+
+A heartbeat callback on the IOLoop reschedules itself every
+WATCHDOG_INTERVAL_S and records how late it ran: the scheduling lag every
+request on the loop sees. A watcher thread checks that the heartbeat keeps
+coming; once it is more than WATCHDOG_THRESHOLD_S overdue the loop is
+blocked, and the watcher captures the loop thread's stack so the stall can
+be attributed to the code that caused it.
+
+Lag percentiles and the call sites that blocked the loop the longest are
+reported by status() for the admin status endpoint.
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from tornado.ioloop import IOLoop
+
+from . import util
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _blocking_site(frame):
+    """
+    Innermost frame of the stack that is in our own code, as
+    "file:line function", or the innermost frame if none is.
+    """
+    innermost = frame
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if os.path.abspath(filename).startswith(APP_DIR):
+            break
+        frame = frame.f_back
+    frame = frame or innermost
+    return '{}:{} {}'.format(os.path.relpath(frame.f_code.co_filename),
+                             frame.f_lineno, frame.f_code.co_name)
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of values, which must be sorted."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1,
+                      int(round(percent / 100 * len(values))) - 1))
+    return values[rank]
+
+
+class LoopWatchdog(object):
+    """Measures IOLoop lag and captures the stacks of long stalls."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config = None
+        self.io_loop = None
+        self.loop_thread = None
+        self.next_beat = None
+        self.captured_beat = None
+        self.captured_site = None
+        self.lags = deque()
+        self.stalls = 0
+        self.site_counts = Counter()
+        self.site_blocked_s = Counter()
+        self.site_stacks = {}
+        self.stop_event = threading.Event()
+
+    def start(self, config):
+        """Starts watching the current thread's IOLoop."""
+        if not config['WATCHDOG_ENABLED'] or self.io_loop is not None:
+            return
+        self.config = config
+        self.lags = deque(maxlen=config['WATCHDOG_WINDOW'])
+        self.io_loop = IOLoop.current()
+        self.loop_thread = threading.get_ident()
+        self._schedule(time.monotonic())
+
+        threading.Thread(target=self._watch, name='interact-watchdog',
+                         daemon=True).start()
+        util.logger.info('Watching IOLoop lag every %ss',
+                         config['WATCHDOG_INTERVAL_S'])
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _schedule(self, now):
+        interval = self.config['WATCHDOG_INTERVAL_S']
+        self.next_beat = now + interval
+        self.io_loop.call_later(interval, self._heartbeat)
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        lag = max(now - self.next_beat, 0)
+
+        with self.lock:
+            self.lags.append(lag)
+            if self.captured_beat == self.next_beat:
+                # End of a stall the watcher caught, now we know how long
+                self.stalls += 1
+                self.site_counts[self.captured_site] += 1
+                self.site_blocked_s[self.captured_site] += lag
+                util.logger.warn('IOLoop blocked for %.3fs at %s', lag,
+                                 self.captured_site,
+                                 extra={'loop_lag_s': lag})
+
+        if not self.stop_event.is_set():
+            self._schedule(now)
+
+    def _watch(self):
+        threshold = self.config['WATCHDOG_THRESHOLD_S']
+        check_interval = min(threshold,
+                             self.config['WATCHDOG_INTERVAL_S']) / 2
+
+        while not self.stop_event.wait(check_interval):
+            due = self.next_beat
+            if due is None or time.monotonic() - due < threshold:
+                continue
+            if self.captured_beat == due:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            site = _blocking_site(frame)
+            stack = traceback.format_stack(frame)
+            with self.lock:
+                self.captured_beat = due
+                self.captured_site = site
+                self.site_stacks[site] = stack
+
+    def status(self):
+        if self.config is None:
+            return {'enabled': False}
+        with self.lock:
+            lags = sorted(self.lags)
+            top = self.site_blocked_s.most_common(
+                self.config['WATCHDOG_TOP_SITES'])
+            return {
+                'enabled': True,
+                'samples': len(lags),
+                'lag_s': {
+                    'p50': _percentile(lags, 50),
+                    'p90': _percentile(lags, 90),
+                    'p99': _percentile(lags, 99),
+                    'max': lags[-1] if lags else None,
+                },
+                'stalls': self.stalls,
+                'blocking_sites': [{
+                    'site': site,
+                    'stalls': self.site_counts[site],
+                    'blocked_s': blocked,
+                    'stack': self.site_stacks.get(site),
+                } for site, blocked in top],
+            }
+
+
+# Started from run.py once the IOLoop exists
+watchdog = LoopWatchdog()
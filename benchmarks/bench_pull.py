@@ -0,0 +1,258 @@
+"""
+Microbenchmarks for the building blocks of pull_from_github.
+
+Generates synthetic upstream repos (see synthetic.py) and times each step of
+a pull separately for four scenarios:
+
+- first_clone : the user has never pulled the repo
+- noop_pull   : nothing changed upstream or locally
+- user_edits  : upstream and the user changed different files
+- conflicts   : upstream and the user changed the same file
+
+Usage, from the repository root:
+
+    python -m benchmarks.bench_pull run --sizes 1000,10000 -o before.json
+    python -m benchmarks.bench_pull compare before.json after.json
+
+Results are JSON so runs on different commits can be compared; compare exits
+with status 1 if any step got slower by more than --threshold.
+"""
+import argparse
+import getpass
+import grp
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import git
+
+from app import util
+from app import pull_from_github as pull
+from app.config import TestConfig
+
+from .synthetic import create_upstream, file_path, push_update
+
+REPO_NAME = 'course'
+SPARSE_PATHS = ['content']
+SCENARIOS = ['first_clone', 'noop_pull', 'user_edits', 'conflicts']
+
+
+def _bench_config(upstream_root, users_root):
+    class BenchConfig(TestConfig):
+        GITHUB_ORG = upstream_root + os.sep
+        COPY_PATH = os.path.join(users_root, '{username}')
+    return BenchConfig()
+
+
+def _timed(timings, name, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    return result
+
+
+def _pull(repo_dir, config, chown_user):
+    """Runs the pull_from_github steps one by one and returns their timings."""
+    timings = {}
+    if not os.path.exists(repo_dir):
+        _timed(timings, '_initialize_repo', pull._initialize_repo,
+               REPO_NAME, repo_dir, config)
+    _timed(timings, '_add_sparse_checkout_paths',
+           pull._add_sparse_checkout_paths, repo_dir, list(SPARSE_PATHS))
+
+    repo = git.Repo(repo_dir)
+    _timed(timings, '_reset_deleted_files', pull._reset_deleted_files, repo)
+    _timed(timings, '_make_commit_if_dirty', pull._make_commit_if_dirty, repo)
+    _timed(timings, '_pull_and_resolve_conflicts',
+           pull._pull_and_resolve_conflicts, repo, config)
+    if chown_user:
+        _timed(timings, 'chown_dir', util.chown_dir, repo_dir, chown_user)
+    return timings
+
+
+def _edit(repo_dir, index, text):
+    with open(os.path.join(repo_dir, file_path(index)), 'a') as outfile:
+        outfile.write(text)
+
+
+def run_scenarios(workdir, num_files, num_commits, chown_user):
+    """One repetition of every scenario on a fresh upstream and user repo."""
+    upstream_root = os.path.join(workdir, 'upstream')
+    users_root = os.path.join(workdir, 'users')
+    config = _bench_config(upstream_root, users_root)
+    upstream = os.path.join(upstream_root, REPO_NAME)
+    repo_dir = os.path.join(users_root, 'bench', REPO_NAME)
+
+    create_upstream(upstream, num_files, num_commits, config['REPO_BRANCH'])
+    results = {}
+
+    results['first_clone'] = _pull(repo_dir, config, chown_user)
+    results['noop_pull'] = _pull(repo_dir, config, chown_user)
+
+    push_update(upstream, config['REPO_BRANCH'], [1, 2, 3], 1)
+    _edit(repo_dir, num_files - 1, 'user edit\n')
+    results['user_edits'] = _pull(repo_dir, config, chown_user)
+
+    push_update(upstream, config['REPO_BRANCH'], [5], 2)
+    _edit(repo_dir, 5, 'conflicting user edit\n')
+    results['conflicts'] = _pull(repo_dir, config, chown_user)
+
+    return results
+
+
+def _chown_user():
+    """chown_dir needs a user with a group of the same name."""
+    username = getpass.getuser()
+    try:
+        grp.getgrnam(username)
+    except KeyError:
+        return None
+    return username
+
+
+def run(args):
+    # util's basicConfig logs DEBUG from every logger, eg. GitPython's Popen
+    util.logger.setLevel('WARNING')
+    logging.getLogger().setLevel(logging.WARNING)
+    # The WIP and merge commits need an identity on machines without one
+    for variable in ['GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME']:
+        os.environ.setdefault(variable, 'Benchmark')
+    for variable in ['GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL']:
+        os.environ.setdefault(variable, 'bench@example.com')
+
+    chown_user = _chown_user()
+    if chown_user is None:
+        print('Skipping chown_dir: cannot chown to the current user')
+
+    histories = {'shallow': 1, 'deep': args.deep_commits}
+    results = []
+    for num_files in [int(size) for size in args.sizes.split(',')]:
+        for history in args.histories.split(','):
+            samples = {scenario: {} for scenario in SCENARIOS}
+            for _ in range(args.repeat):
+                workdir = tempfile.mkdtemp(prefix='interact-bench-')
+                try:
+                    timings = run_scenarios(workdir, num_files,
+                                            histories[history], chown_user)
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                for scenario, steps in timings.items():
+                    for step, seconds in steps.items():
+                        samples[scenario].setdefault(step, []).append(seconds)
+
+            for scenario in SCENARIOS:
+                result = {
+                    'files': num_files,
+                    'history': history,
+                    'scenario': scenario,
+                    'samples': samples[scenario],
+                    'median': {step: statistics.median(values)
+                               for step, values in samples[scenario].items()},
+                }
+                results.append(result)
+                print('{:>7} files {:>8} {:<12} {}'.format(
+                    num_files, history, scenario, '  '.join(
+                        '{}={:.3f}s'.format(step, seconds)
+                        for step, seconds in result['median'].items())))
+
+    output = {'meta': _metadata(args), 'results': results}
+    with open(args.output, 'w') as outfile:
+        json.dump(output, outfile, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+
+def _metadata(args):
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        commit = None
+    return {
+        'commit': commit,
+        'git_version': subprocess.check_output(['git', '--version'])
+                                 .decode().strip(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': args.repeat,
+    }
+
+
+def compare(args):
+    with open(args.before) as infile:
+        before = json.load(infile)
+    with open(args.after) as infile:
+        after = json.load(infile)
+
+    def by_key(output):
+        return {(r['files'], r['history'], r['scenario']): r['median']
+                for r in output['results']}
+
+    before_results = by_key(before)
+    regressions = 0
+    for key, after_median in sorted(by_key(after).items()):
+        before_median = before_results.get(key)
+        if before_median is None:
+            continue
+        for step, seconds in sorted(after_median.items()):
+            old = before_median.get(step)
+            if not old:
+                continue
+            change = (seconds - old) / old
+            flag = ''
+            if change > args.threshold and seconds - old > args.min_delta:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('{:>7} {:>8} {:<12} {:<28} {:.3f}s -> {:.3f}s ({:+.0%}){}'
+                  .format(key[0], key[1], key[2], step, old, seconds, change,
+                          flag))
+
+    print('{} regressions ({} -> {})'.format(
+        regressions, before['meta'].get('commit'), after['meta'].get('commit')))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the steps of pull_from_github')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks')
+    run_parser.add_argument('--sizes', default='1000,10000,100000',
+                            help='Comma-separated numbers of files')
+    run_parser.add_argument('--histories', default='shallow,deep',
+                            help='Comma-separated subset of shallow,deep')
+    run_parser.add_argument('--deep-commits', type=int, default=1000,
+                            help='Number of commits in a deep history')
+    run_parser.add_argument('--repeat', type=int, default=3,
+                            help='Repetitions per configuration')
+    run_parser.add_argument('-o', '--output', default='bench_results.json')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare two result files')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative slowdown counted as regression')
+    compare_parser.add_argument('--min-delta', type=float, default=0.005,
+                                help='Ignore slowdowns smaller than this (s)')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""
+Replays recorded request traces (see app/tracing.py) against a local interact
+instance, to compare configurations and code versions under a realistic
+traffic shape.
+
+Usage, from the repository root:
+
+    python -m benchmarks.replay prepare traces.jsonl --root /tmp/replay
+    python -m benchmarks.replay serve --root /tmp/replay --set JOB_WORKERS_MAX=8
+    python -m benchmarks.replay play traces.jsonl --speed 10 -o run.json
+    python -m benchmarks.replay compare before.json after.json
+
+prepare creates a local upstream repo (see synthetic.py) for every repo in
+the traces, containing the traced paths, and a notebook for every traced
+?file= link. serve runs the app against them with the development config, so
+authentication is mocked and no hub is needed. play sends every traced
+request at its recorded offset divided by --speed, as the landing page
+request followed by the websocket the progress page opens, and reports
+latency percentiles.
+"""
+import argparse
+import ast
+import json
+import os
+import posixpath
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+from app import messages
+from app.config import DevelopmentConfig
+from app.handlers import parse_repo_groups
+
+from .synthetic import add_paths, create_upstream
+
+PERCENTILES = [50, 90, 99]
+
+FINAL_MESSAGES = {messages.TYPES['redirect'], messages.TYPES['error']}
+
+
+def load_traces(path):
+    with open(path) as infile:
+        traces = [json.loads(line) for line in infile if line.strip()]
+    return sorted(traces, key=lambda entry: entry['time'])
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of values, which must be sorted."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1,
+                      int(round(percent / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def prepare(args):
+    """Creates the upstream repos and files that the traces refer to."""
+    traces = load_traces(args.traces)
+    branch = DevelopmentConfig.REPO_BRANCH
+
+    repo_paths, files = {}, set()
+    for entry in traces:
+        trace_args = entry['args']
+        if 'file' in trace_args:
+            files.add(posixpath.basename(trace_args['file']))
+            continue
+        try:
+            groups = parse_repo_groups(trace_args.get('repo', []),
+                                       trace_args.get('path', []),
+                                       DevelopmentConfig.MAX_REPO_GROUPS)
+        except ValueError:
+            continue
+        for repo, paths in groups:
+            repo_paths.setdefault(repo, set()).update(paths)
+
+    for repo, paths in sorted(repo_paths.items()):
+        repo_dir = os.path.join(args.root, 'upstream', repo)
+        if os.path.exists(repo_dir):
+            print('Keeping existing {}'.format(repo_dir))
+            continue
+        create_upstream(repo_dir, args.files, args.commits, branch)
+        add_paths(repo_dir, branch, paths)
+        print('Created {} with {} traced paths'.format(repo_dir, len(paths)))
+
+    files_dir = os.path.join(args.root, 'files')
+    os.makedirs(files_dir, exist_ok=True)
+    for filename in files:
+        with open(os.path.join(files_dir, filename), 'w') as outfile:
+            json.dump({'cells': [], 'metadata': {}, 'nbformat': 4,
+                       'nbformat_minor': 0}, outfile)
+    print('Created {} files in {}'.format(len(files), files_dir))
+
+
+def _parse_override(override):
+    key, _, value = override.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return key, value
+
+
+def replay_config(root, port, files_port, overrides):
+    """DevelopmentConfig pointing at the repos and files made by prepare."""
+    root = os.path.abspath(root)
+
+    class ReplayConfig(DevelopmentConfig):
+        PORT = port
+        GITHUB_ORG = os.path.join(root, 'upstream') + os.sep
+        COPY_PATH = os.path.join(root, 'users', '{username}')
+        MIRROR_PATH = os.path.join(root, 'mirrors')
+        ARCHIVE_PATH = os.path.join(root, 'archives')
+        ALLOWED_DOMAIN = 'http://localhost:{}/'.format(files_port)
+        LOG_LEVEL = 'WARNING'
+        MAINTENANCE_ENABLED = False
+        TRACE_ENABLED = False
+
+    config = ReplayConfig()
+    for key, value in overrides:
+        setattr(config, key, value)
+    return config
+
+
+def serve(args):
+    from app.interact_app import InteractApp
+
+    overrides = [_parse_override(override) for override in args.set]
+    config = replay_config(args.root, args.port, args.files_port, overrides)
+
+    # Serves the ?file= notebooks from a separate process, so they don't
+    # compete with the app for its IOLoop
+    file_server = subprocess.Popen(
+        [sys.executable, '-m', 'http.server', str(args.files_port)],
+        cwd=os.path.join(args.root, 'files'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        app = InteractApp(config=config)
+        app.listen(config['PORT'])
+        print('Serving {} on port {} ({})'.format(
+            args.root, config['PORT'],
+            ', '.join(args.set) or 'default config'))
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        file_server.terminate()
+
+
+def _query(trace_args, files_port):
+    if 'file' in trace_args:
+        return urlencode({'file': 'http://localhost:{}/{}'.format(
+            files_port, posixpath.basename(trace_args['file']))})
+    return urlencode([('repo', repo) for repo in trace_args['repo']] +
+                     [('path', path) for path in trace_args['path']])
+
+
+@gen.coroutine
+def _replay_request(entry, url, files_port):
+    """
+    Sends one traced request the way a browser would and waits for the final
+    websocket message.
+    """
+    query = _query(entry['args'], files_port)
+    result = {
+        'kind': 'file' if 'file' in entry['args'] else 'repo',
+        'recorded_latency_s': entry.get('latency_s'),
+    }
+    start = time.time()
+    try:
+        response = yield AsyncHTTPClient().fetch(
+            '{}?{}'.format(url, query), raise_error=False,
+            follow_redirects=False, request_timeout=600)
+        result['landing_s'] = time.time() - start
+        if response.code != 200:
+            result['result'] = 'HTTP {}'.format(response.code)
+            return result
+
+        socket_url = 'ws{}socket/{}?{}'.format(url[len('http'):],
+                                               entry['user'], query)
+        connection = yield websocket_connect(socket_url)
+        result['result'] = 'CLOSED'
+        while True:
+            message = yield connection.read_message()
+            if message is None:
+                break
+            message_type = json.loads(message)['type']
+            if message_type in FINAL_MESSAGES:
+                result['result'] = message_type
+                break
+        connection.close()
+    except Exception as e:
+        result['result'] = 'FAILED: {}'.format(e)
+    finally:
+        result['latency_s'] = time.time() - start
+    return result
+
+
+@gen.coroutine
+def _play(traces, args):
+    first = traces[0]['time']
+    started = time.time()
+    requests = []
+    for entry in traces:
+        delay = (entry['time'] - first) / args.speed - (time.time() - started)
+        if delay > 0:
+            yield gen.sleep(delay)
+        requests.append(_replay_request(entry, args.url, args.files_port))
+    results = yield requests
+    return results, time.time() - started
+
+
+def summarize(results):
+    summary = {}
+    for kind in ['all', 'file', 'repo']:
+        selected = [r for r in results
+                    if kind == 'all' or r['kind'] == kind]
+        if not selected:
+            continue
+        latencies = sorted(r['latency_s'] for r in selected)
+        recorded = sorted(r['recorded_latency_s'] for r in selected
+                          if r['recorded_latency_s'] is not None)
+        results_count = {}
+        for r in selected:
+            results_count[r['result']] = results_count.get(r['result'], 0) + 1
+        summary[kind] = {
+            'requests': len(selected),
+            'results': results_count,
+            'latency_s': {'p{}'.format(p): percentile(latencies, p)
+                          for p in PERCENTILES},
+            'recorded_latency_s': {'p{}'.format(p): percentile(recorded, p)
+                                   for p in PERCENTILES},
+        }
+        summary[kind]['latency_s']['max'] = latencies[-1]
+    return summary
+
+
+def _print_summary(summary):
+    for kind, stats in sorted(summary.items()):
+        print('{:<5} {:>6} requests  {}  (recorded {})  {}'.format(
+            kind, stats['requests'],
+            '  '.join('{}={:.2f}s'.format(name, seconds) for name, seconds
+                      in sorted(stats['latency_s'].items())),
+            '  '.join('{}={:.2f}s'.format(name, seconds) for name, seconds
+                      in sorted(stats['recorded_latency_s'].items())
+                      if seconds is not None),
+            ', '.join('{}: {}'.format(result, count) for result, count
+                      in sorted(stats['results'].items()))))
+
+
+def play(args):
+    traces = load_traces(args.traces)
+    if args.limit:
+        traces = traces[:args.limit]
+    if not traces:
+        print('No traces in {}'.format(args.traces))
+        return
+
+    AsyncHTTPClient.configure(None, max_clients=args.max_clients)
+    results, duration = IOLoop.current().run_sync(
+        lambda: _play(traces, args))
+
+    summary = summarize(results)
+    print('Replayed {} requests in {:.1f}s at {}x speed'.format(
+        len(results), duration, args.speed))
+    _print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump({
+                'meta': {'traces': args.traces, 'speed': args.speed,
+                         'label': args.label,
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+                'summary': summary,
+                'results': results,
+            }, outfile, indent=2, sort_keys=True)
+        print('Results written to {}'.format(args.output))
+
+
+def compare(args):
+    runs = []
+    for path in args.runs:
+        with open(path) as infile:
+            runs.append(json.load(infile))
+
+    for kind in ['all', 'file', 'repo']:
+        for run_path, run in zip(args.runs, runs):
+            stats = run['summary'].get(kind)
+            if stats is None:
+                continue
+            print('{:<5} {:<30} {}'.format(
+                kind, run['meta'].get('label') or run_path,
+                '  '.join('{}={:.2f}s'.format(name, seconds) for name, seconds
+                          in sorted(stats['latency_s'].items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays recorded interact traces')
+    subparsers = parser.add_subparsers(dest='command')
+
+    prepare_parser = subparsers.add_parser(
+        'prepare', help='Create the repos and files the traces refer to')
+    prepare_parser.add_argument('traces')
+    prepare_parser.add_argument('--root', default='replay')
+    prepare_parser.add_argument('--files', type=int, default=1000,
+                                help='Synthetic files per repo')
+    prepare_parser.add_argument('--commits', type=int, default=100,
+                                help='Commits of history per repo')
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='Run interact against the prepared repos')
+    serve_parser.add_argument('--root', default='replay')
+    serve_parser.add_argument('--port', type=int, default=8002)
+    serve_parser.add_argument('--files-port', type=int, default=8003)
+    serve_parser.add_argument('--set', action='append', default=[],
+                              metavar='KEY=VALUE',
+                              help='Override a config value, eg. '
+                                   'JOB_WORKERS_MAX=8')
+
+    play_parser = subparsers.add_parser(
+        'play', help='Send the traced requests to a running instance')
+    play_parser.add_argument('traces')
+    play_parser.add_argument('--url', default='http://localhost:8002/')
+    play_parser.add_argument('--files-port', type=int, default=8003)
+    play_parser.add_argument('--speed', type=float, default=1,
+                             help='Replay this many times faster')
+    play_parser.add_argument('--limit', type=int,
+                             help='Only replay the first N requests')
+    play_parser.add_argument('--max-clients', type=int, default=1000,
+                             help='Concurrent landing page requests')
+    play_parser.add_argument('--label', help='Name of the run in compare')
+    play_parser.add_argument('-o', '--output')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare the latencies of several play runs')
+    compare_parser.add_argument('runs', nargs='+')
+
+    args = parser.parse_args()
+    if args.command == 'prepare':
+        prepare(args)
+    elif args.command == 'serve':
+        serve(args)
+    elif args.command == 'play':
+        play(args)
+    elif args.command == 'compare':
+        compare(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Generates synthetic upstream repositories for benchmarks.
+
+Repos are written with git fast-import so that even 100k-file repos with
+long histories take seconds to build. The layout mimics a course repo:
+
+    content/dir000/file00000.txt
+    content/dir000/file00001.ipynb
+    ...
+    README.md
+    .gitignore
+"""
+import os
+import subprocess
+
+FILES_PER_DIR = 100
+
+AUTHOR = 'Benchmark <bench@example.com>'
+
+
+def file_path(index):
+    """Path of the index'th synthetic file."""
+    extension = 'ipynb' if index % 10 == 0 else 'txt'
+    return 'content/dir{:03d}/file{:05d}.{}'.format(
+        index // FILES_PER_DIR, index, extension)
+
+
+def _file_contents(index, revision):
+    return ('file {} revision {}\n'.format(index, revision) +
+            'line\n' * (index % 20)).encode('utf-8')
+
+
+def _data(contents):
+    return b'data ' + str(len(contents)).encode('utf-8') + b'\n' + contents + b'\n'
+
+
+class _Stream(object):
+    """Builds a fast-import stream with increasing commit timestamps."""
+
+    def __init__(self, branch):
+        self.ref = 'refs/heads/' + branch
+        self.chunks = []
+        self.time = 1500000000
+
+    def commit(self, message, changes, parent=None):
+        """changes is a list of (path, contents) pairs."""
+        self.time += 60
+        self.chunks.append('commit {}\n'.format(self.ref).encode('utf-8'))
+        self.chunks.append('committer {} {} +0000\n'.format(
+            AUTHOR, self.time).encode('utf-8'))
+        self.chunks.append(_data(message.encode('utf-8')))
+        if parent:
+            self.chunks.append('from {}\n'.format(parent).encode('utf-8'))
+        for path, contents in changes:
+            self.chunks.append('M 100644 inline {}\n'.format(path)
+                               .encode('utf-8'))
+            self.chunks.append(_data(contents))
+        self.chunks.append(b'\n')
+
+    def run(self, repo_dir):
+        subprocess.run(['git', 'fast-import', '--quiet'], cwd=repo_dir,
+                       input=b''.join(self.chunks), check=True)
+
+
+def create_upstream(repo_dir, num_files, num_commits, branch):
+    """
+    Creates a bare repo at repo_dir with num_files files on branch.
+
+    The first commit adds every file; each of the num_commits - 1 following
+    commits modifies a handful of them.
+    """
+    os.makedirs(repo_dir)
+    subprocess.run(['git', 'init', '-q', '--bare'], cwd=repo_dir, check=True)
+    subprocess.run(['git', 'symbolic-ref', 'HEAD', 'refs/heads/' + branch],
+                   cwd=repo_dir, check=True)
+
+    stream = _Stream(branch)
+    initial = [('README.md', b'# Synthetic course repo\n'),
+               ('.gitignore', b'*.pyc\n')]
+    initial += [(file_path(i), _file_contents(i, 0)) for i in range(num_files)]
+    stream.commit('Initial commit', initial)
+
+    for revision in range(1, num_commits):
+        changed = [(revision * 7 + k * 131) % num_files for k in range(5)]
+        stream.commit('Update {}'.format(revision),
+                      [(file_path(i), _file_contents(i, revision))
+                       for i in changed])
+    stream.run(repo_dir)
+
+
+def push_update(repo_dir, branch, indices, revision):
+    """Adds a commit to the bare repo modifying the given file indices."""
+    stream = _Stream(branch)
+    stream.time += 10 ** 7 + revision
+    stream.commit('Upstream update {}'.format(revision),
+                  [(file_path(i), _file_contents(i, 'upstream-{}'.format(
+                      revision))) for i in indices],
+                  parent='refs/heads/{}^0'.format(branch))
+    stream.run(repo_dir)
+
+
+def add_paths(repo_dir, branch, paths):
+    """
+    Adds a commit to the bare repo creating the given paths. Paths with an
+    extension, which aren't the parent of another path, become files; the
+    others become directories holding a notebook.
+    """
+    paths = set(path.strip('/') for path in paths)
+    parents = set()
+    for path in paths:
+        parts = path.split('/')
+        parents.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+    changes = []
+    for path in sorted(paths):
+        if os.path.splitext(path)[1] and path not in parents:
+            changes.append((path, 'synthetic {}\n'.format(path)
+                            .encode('utf-8')))
+        else:
+            changes.append((path + '/index.ipynb', b'{}\n'))
+
+    stream = _Stream(branch)
+    stream.time += 2 * 10 ** 7
+    stream.commit('Add traced paths', changes,
+                  parent='refs/heads/{}^0'.format(branch))
+    stream.run(repo_dir)
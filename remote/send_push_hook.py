@@ -0,0 +1,50 @@
+"""
+Stand-in for Github's push webhook, for testing the webhook endpoint locally.
+
+Sends a signed push notification for a repo to a running interact server:
+
+    python remote/send_push_hook.py textbook
+    python remote/send_push_hook.py textbook --url http://localhost:8002/webhook
+
+The default secret matches WEBHOOK_SECRET in the development config.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+
+import requests
+
+
+def send_push_hook(url, repo, branch, secret, event='push'):
+    body = json.dumps({
+        'ref': 'refs/heads/' + branch,
+        'repository': {
+            'name': repo,
+            'full_name': 'data-8/' + repo,
+        },
+    }).encode('utf-8')
+    signature = hmac.new(secret.encode('utf-8'), body,
+                         hashlib.sha256).hexdigest()
+
+    return requests.post(url, data=body, headers={
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': event,
+        'X-Hub-Signature-256': 'sha256=' + signature,
+    })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Sends a Github-style push webhook to interact')
+    parser.add_argument('repo', help='Name of the pushed repo')
+    parser.add_argument('--branch', default='gh-pages')
+    parser.add_argument('--url', default='http://localhost:8002/webhook')
+    parser.add_argument('--secret', default='your_webhook_secret_here')
+    parser.add_argument('--event', default='push',
+                        help='X-GitHub-Event header, eg. push or ping')
+    args = parser.parse_args()
+
+    response = send_push_hook(args.url, args.repo, args.branch, args.secret,
+                              event=args.event)
+    print(response.status_code, response.text)
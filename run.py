@@ -4,6 +4,7 @@ import tornado.ioloop
 from app.interact_app import InteractApp
 from app.config import config_for_env
 from app.util import logger
+from app.watchdog import watchdog
 
 import argparse
 
@@ -29,6 +30,9 @@ config = config_for_env(env_name)
 if __name__ == '__main__':
     app = InteractApp(config=config)
     app.listen(config['PORT'])
+    app.warmup.start()
+    app.maintenance.start()
+    watchdog.start(config)
 
     logger.info('Starting interact app on port {}'.format(config['PORT']))
     tornado.ioloop.IOLoop.current().start()
@@ -1,12 +1,11 @@
-from app import create_app
 import pytest
 
 
 @pytest.fixture(scope='session')
 def app():
 	"""Creates an app with test settings"""
-	app = create_app()
-	return app
-
-
-test = app()
\ No newline at end of file
+	# Imported here so that tests of modules that do not need the app can
+	# run without importing all of its handlers
+	from app.config import config_for_env
+	from app.interact_app import InteractApp
+	return InteractApp(config=config_for_env('testing'))
@@ -0,0 +1,132 @@
+import threading
+
+import pytest
+
+from app import concurrency
+from app.concurrency import AdaptiveExecutor
+
+CONFIG = {
+    'JOB_WORKERS_MIN': 2,
+    'JOB_WORKERS_MAX': 16,
+    'JOB_WORKERS_INITIAL': 8,
+    'JOB_TARGET_QUEUE_WAIT_S': 2,
+    'JOB_CPU_PRESSURE_MAX': 1.5,
+    'JOB_IO_PRESSURE_MAX': 0.4,
+    'JOB_WORKERS_DECREASE_FACTOR': 0.5,
+    'JOB_ADJUST_INTERVAL_S': 0,
+}
+
+
+@pytest.fixture
+def pressure(monkeypatch):
+    """Sets the CPU and IO pressure the executor sees, none by default."""
+    values = {'cpu': 0.1, 'io': 0.0}
+    monkeypatch.setattr(concurrency, 'cpu_pressure', lambda: values['cpu'])
+    monkeypatch.setattr(concurrency, 'io_pressure', lambda: values['io'])
+    return values
+
+
+@pytest.fixture
+def executor():
+    executor = AdaptiveExecutor()
+    executor.configure(CONFIG)
+    yield executor
+    executor.executor.shutdown()
+
+
+def queue_jobs(executor, count):
+    executor.queue.extend([None] * count)
+
+
+def test_slow_jobs_without_pressure_keep_limit(executor, pressure):
+    # A pull of a big repo over a slow network doesn't load the machine
+    for _ in range(5):
+        executor._adjust(600, 0)
+    assert executor.limit == 8
+    assert not executor.decisions
+
+
+def test_cpu_pressure_decreases(executor, pressure):
+    pressure['cpu'] = 2
+    executor._adjust(1, 0)
+    assert executor.limit == 4
+    assert 'cpu pressure' in executor.decisions[-1]['reason']
+
+
+def test_io_pressure_decreases(executor, pressure):
+    pressure['io'] = 0.8
+    executor._adjust(1, 0)
+    assert executor.limit == 4
+    assert 'io pressure' in executor.decisions[-1]['reason']
+
+
+def test_decrease_stops_at_min(executor, pressure):
+    pressure['cpu'] = 2
+    for _ in range(5):
+        executor._adjust(1, 0)
+    assert executor.limit == CONFIG['JOB_WORKERS_MIN']
+
+
+def test_pressure_beats_queue(executor, pressure):
+    pressure['io'] = 0.8
+    queue_jobs(executor, 10)
+    executor._adjust(1, 30)
+    assert executor.limit == 4
+
+
+def test_long_queue_wait_increases(executor, pressure):
+    queue_jobs(executor, 3)
+    executor._adjust(1, 10)
+    assert executor.limit == 9
+    assert '3 queued' in executor.decisions[-1]['reason']
+
+
+def test_increase_stops_at_max(executor, pressure):
+    queue_jobs(executor, 3)
+    for _ in range(20):
+        executor._adjust(1, 10)
+    assert executor.limit == CONFIG['JOB_WORKERS_MAX']
+
+
+def test_short_queue_wait_keeps_limit(executor, pressure):
+    queue_jobs(executor, 3)
+    executor._adjust(1, 0.5)
+    assert executor.limit == 8
+
+
+def test_empty_queue_keeps_limit(executor, pressure):
+    executor._adjust(1, 10)
+    assert executor.limit == 8
+
+
+def test_adjust_interval(executor, pressure):
+    executor.config = dict(CONFIG, JOB_ADJUST_INTERVAL_S=60)
+    pressure['cpu'] = 2
+    executor._adjust(1, 0)
+    executor._adjust(1, 0)
+    assert executor.limit == 4
+    # Still tracked in between adjustments
+    assert executor.latency == 1
+
+
+def test_submit_runs_jobs(executor, pressure):
+    futures = [executor.submit(pow, 2, n) for n in range(20)]
+    assert [future.result(timeout=5) for future in futures] == [
+        2 ** n for n in range(20)]
+
+
+def test_try_submit_within_limit(executor, pressure):
+    assert executor.try_submit(pow, 2, 3).result(timeout=5) == 8
+
+
+def test_try_submit_counts_against_limit(executor, pressure):
+    release = threading.Event()
+    executor.limit = 2
+    running = [executor.submit(release.wait, 5) for _ in range(2)]
+
+    assert executor.try_submit(pow, 2, 3) is None
+    assert not executor.queue
+
+    release.set()
+    for future in running:
+        future.result(timeout=5)
@@ -0,0 +1,28 @@
+import os
+import subprocess
+
+from app.git_maintenance import find_user_repos
+
+
+def make_repo(repo_dir, origin=None):
+    subprocess.check_call(['git', 'init', '-q', repo_dir])
+    if origin:
+        subprocess.check_call(['git', '-C', repo_dir, 'remote', 'add',
+                               'origin', origin])
+
+
+def test_find_user_repos_ignores_token(tmpdir):
+    home = str(tmpdir)
+    make_repo(os.path.join(home, 'alice', 'lab'),
+              'https://old-token@github.com/data-8/lab')
+    make_repo(os.path.join(home, 'alice', 'own'),
+              'https://github.com/alice/own')
+    make_repo(os.path.join(home, 'bob', 'scratch'))
+    config = {
+        'COPY_PATH': os.path.join(home, '{username}'),
+        'GITHUB_ORG': 'https://new-token@github.com/data-8/',
+    }
+
+    assert list(find_user_repos(config)) == [
+        ('alice', os.path.join(home, 'alice', 'lab')),
+    ]
@@ -0,0 +1,140 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+from tornado.ioloop import IOLoop
+
+from app import handlers
+from app.handlers import parse_repo_groups, repo_groups_query
+from app.tree_index import TreeIndex
+
+
+def test_single_repo():
+    groups = parse_repo_groups(['lab'], ['lab01', 'lab01/lab01.ipynb'], 4)
+    assert groups == [('lab', ['lab01', 'lab01/lab01.ipynb'])]
+
+
+def test_paths_grouped_by_repo_prefix():
+    groups = parse_repo_groups(
+        ['lab', 'data'], ['lab01', 'data:tables/cities.csv', 'lab02'], 4)
+    assert groups == [
+        ('lab', ['lab01', 'lab02']),
+        ('data', ['tables/cities.csv']),
+    ]
+
+
+def test_unknown_prefix_belongs_to_first_repo():
+    groups = parse_repo_groups(['lab'], ['notes:week1'], 4)
+    assert groups == [('lab', ['notes:week1'])]
+
+
+def test_repo_without_paths():
+    with pytest.raises(ValueError):
+        parse_repo_groups(['lab', 'data'], ['lab01'], 4)
+
+
+def test_no_paths():
+    with pytest.raises(ValueError):
+        parse_repo_groups(['lab'], [], 4)
+
+
+def test_no_repo():
+    with pytest.raises(ValueError):
+        parse_repo_groups([], ['lab01'], 4)
+
+
+def test_too_many_repos():
+    repos = ['lab', 'data', 'hw', 'proj', 'extra']
+    paths = ['lab01'] + ['{}:x'.format(repo) for repo in repos[1:]]
+
+    with pytest.raises(ValueError):
+        parse_repo_groups(repos, paths, 4)
+    assert len(parse_repo_groups(repos, paths, 5)) == 5
+
+
+def test_query_round_trip():
+    groups = [('lab', ['lab01', 'lab02']), ('data', ['tables'])]
+    query = repo_groups_query(groups)
+
+    assert query == ('repo=lab&repo=data&path=lab01&path=lab02'
+                     '&path=data:tables')
+
+    values = [value.split('=', 1) for value in query.split('&')]
+    repos = [value for key, value in values if key == 'repo']
+    paths = [value for key, value in values if key == 'path']
+    assert parse_repo_groups(repos, paths, 4) == groups
+
+
+class FakeRefresher(object):
+    def __init__(self, on_refresh):
+        self.on_refresh = on_refresh
+        self.refreshes = 0
+
+    def request_refresh(self, repo_name, config):
+        self.refreshes += 1
+        self.on_refresh()
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """
+    A mirror of lab at commit old, with tree indexes for it and for new, the
+    commit Github's branch is at.
+    """
+    state = {'mirror': 'old', 'remote': 'new'}
+    indexes = {
+        'old': TreeIndex('lab', 'old', frozenset(['lab01.ipynb']),
+                         frozenset()),
+        'new': TreeIndex('lab', 'new',
+                         frozenset(['lab01.ipynb', 'lab02.ipynb']),
+                         frozenset()),
+    }
+
+    def refresh():
+        state['mirror'] = state['remote']
+
+    refresher = FakeRefresher(refresh)
+    monkeypatch.setattr(handlers, 'options', SimpleNamespace(config={
+        'MIRROR_MISS_REFRESH_TIMEOUT_S': 5,
+    }))
+    monkeypatch.setattr(handlers.tree_index, 'get_index',
+                        lambda repo_name, config: indexes[state['mirror']])
+    monkeypatch.setattr(handlers.mirror, 'remote_tip',
+                        lambda repo_name, config: state['remote'])
+    monkeypatch.setattr(handlers.mirror, 'refresher', refresher)
+    state['refresher'] = refresher
+    return state
+
+
+def resolve(repo_name, paths):
+    return IOLoop.current().run_sync(
+        lambda: handlers.resolve_git_paths(repo_name, paths))
+
+
+def test_resolve_refreshes_mirror_for_new_path(upstream):
+    index, paths, missing = resolve('lab', ['lab02.ipynb'])
+
+    assert index.commit == 'new'
+    assert paths == ['lab02.ipynb']
+    assert missing == []
+    assert upstream['refresher'].refreshes == 1
+
+
+def test_resolve_missing_path_at_remote_tip(upstream):
+    upstream['remote'] = 'old'
+    index, _, missing = resolve('lab', ['lab03.ipynb'])
+
+    assert index.commit == 'old'
+    assert missing == ['lab03.ipynb']
+    assert upstream['refresher'].refreshes == 0
+
+
+def test_resolve_existing_path_skips_refresh(upstream):
+    index, _, missing = resolve('lab', ['lab01.ipynb'])
+
+    assert index.commit == 'old'
+    assert missing == []
+    assert upstream['refresher'].refreshes == 0
@@ -0,0 +1,146 @@
+import socket
+import threading
+import time
+from urllib.request import urlopen
+
+import pytest
+
+from app.jobs import CancelToken, JobCancelled, JobRegistry, shutdown_response
+
+
+def test_cancel_runs_callbacks_once():
+    token = CancelToken()
+    calls = []
+    with token.on_cancel(lambda: calls.append('abort')):
+        token.cancel('first')
+        token.cancel('second')
+
+    assert token.cancelled
+    assert token.reason == 'first'
+    assert calls == ['abort']
+
+
+def test_check_raises_once_cancelled():
+    token = CancelToken()
+    token.check()
+
+    token.cancel('Stop')
+    with pytest.raises(JobCancelled) as excinfo:
+        token.check()
+    assert str(excinfo.value) == 'Stop'
+
+
+def test_on_cancel_after_cancel_runs_immediately():
+    token = CancelToken()
+    token.cancel('Stop')
+
+    calls = []
+    with token.on_cancel(lambda: calls.append('abort')):
+        assert calls == ['abort']
+
+
+def test_on_cancel_callback_dropped_after_block():
+    token = CancelToken()
+    calls = []
+    with token.on_cancel(lambda: calls.append('abort')):
+        pass
+    token.cancel('Stop')
+
+    assert calls == []
+
+
+def test_phase_times_out():
+    token = CancelToken()
+    with pytest.raises(JobCancelled) as excinfo:
+        with token.phase('clone', 0.01):
+            time.sleep(0.2)
+    assert 'clone timed out' in str(excinfo.value)
+
+
+def test_phase_within_timeout():
+    token = CancelToken()
+    with token.phase('clone', 10):
+        pass
+    assert not token.cancelled
+
+
+def test_attach_shares_running_job():
+    registry = JobRegistry()
+    job, created = registry.attach('key', 'tab1')
+    same_job, joined_created = registry.attach('key', 'tab2')
+
+    assert created
+    assert not joined_created
+    assert same_job is job
+    assert job.clients == {'tab1', 'tab2'}
+
+
+def test_detach_cancels_when_last_client_leaves():
+    registry = JobRegistry()
+    job, _ = registry.attach('key', 'tab1')
+    registry.attach('key', 'tab2')
+
+    registry.detach('key', 'tab1')
+    assert not job.token.cancelled
+
+    registry.detach('key', 'tab2')
+    assert job.token.cancelled
+
+
+def test_reload_starts_new_job():
+    registry = JobRegistry()
+    old_job, _ = registry.attach('key', 'tab')
+    # The only tab is reloaded: its socket closes before the new one opens,
+    # while the old job is still winding down.
+    registry.detach('key', 'tab')
+    new_job, created = registry.attach('key', 'reloaded tab')
+
+    assert created
+    assert new_job is not old_job
+    assert not new_job.token.cancelled
+
+    # The old job finishing doesn't unregister the new one
+    registry.finish('key', old_job)
+    assert registry.jobs['key'] is new_job
+
+    registry.finish('key', new_job)
+    assert 'key' not in registry.jobs
+
+
+def test_detach_of_old_client_leaves_new_job_alone():
+    registry = JobRegistry()
+    registry.attach('key', 'tab')
+    registry.jobs['key'].token.cancel('Timed out')
+    new_job, _ = registry.attach('key', 'other tab')
+
+    registry.detach('key', 'tab')
+
+    assert new_job.clients == {'other tab'}
+    assert not new_job.token.cancelled
+
+
+def test_shutdown_response_interrupts_blocked_read():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def trickle():
+        client, _ = server.accept()
+        client.recv(4096)
+        client.sendall(b'HTTP/1.0 200 OK\r\nContent-Length: 100\r\n\r\nx')
+        time.sleep(5)
+        client.close()
+
+    threading.Thread(target=trickle, daemon=True).start()
+    response = urlopen('http://127.0.0.1:{}/'.format(server.getsockname()[1]),
+                       timeout=10)
+    token = CancelToken()
+    threading.Timer(0.2, token.cancel, ['Closed']).start()
+
+    start = time.time()
+    with token.on_cancel(shutdown_response(response)):
+        with pytest.raises(Exception):
+            response.read()
+    assert time.time() - start < 2
+    response.close()
+    server.close()
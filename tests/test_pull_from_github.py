@@ -0,0 +1,42 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from app.pull_from_github import _restore_repo_state
+
+
+@pytest.fixture
+def repo_dir(tmpdir):
+    subprocess.check_call(['git', 'init', '-q', str(tmpdir)])
+    return str(tmpdir)
+
+
+def write_lock(repo_dir, age):
+    path = os.path.join(repo_dir, '.git', 'index.lock')
+    open(path, 'w').close()
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_locks_kept_if_nothing_was_killed(repo_dir):
+    lock = write_lock(repo_dir, 0)
+    _restore_repo_state(repo_dir)
+    assert os.path.exists(lock)
+
+
+def test_locks_of_killed_process_removed(repo_dir):
+    started_at = time.time() - 10
+    lock = write_lock(repo_dir, 5)
+    _restore_repo_state(repo_dir, started_at)
+    assert not os.path.exists(lock)
+
+
+def test_older_locks_kept(repo_dir):
+    # Eg. the user's own git, running since before the pull started
+    started_at = time.time() - 10
+    lock = write_lock(repo_dir, 60)
+    _restore_repo_state(repo_dir, started_at)
+    assert os.path.exists(lock)
@@ -0,0 +1,55 @@
+import pytest
+
+from app.tree_index import TreeIndex, redirect_url
+
+CONFIG = {
+    'FILE_REDIRECT_PATH': '/user/{username}/notebooks/{destination}',
+    'GIT_REDIRECT_PATH': '/user/{username}/tree/{destination}',
+}
+
+
+@pytest.fixture
+def index():
+    return TreeIndex(
+        'lab', 'abc123',
+        files=frozenset(['README.md', 'lab01/lab01.ipynb', 'lab01/data.csv']),
+        dirs=frozenset(['lab01']),
+    )
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('lab01', 'lab01'),
+    ('lab01/', 'lab01'),
+    ('/lab01', 'lab01'),
+    ('./lab01//lab01.ipynb', 'lab01/lab01.ipynb'),
+    (' README.md ', 'README.md'),
+    ('lab02', None),
+    ('lab01/missing.ipynb', None),
+    ('../lab01', 'lab01'),
+])
+def test_normalize(index, path, expected):
+    assert index.normalize(path) == expected
+
+
+def test_is_dir(index):
+    assert index.is_dir('lab01')
+    assert not index.is_dir('README.md')
+
+
+def test_redirect_notebook(index):
+    assert (redirect_url(index, CONFIG, 'alice', 'lab01/lab01.ipynb') ==
+            '/user/alice/notebooks/lab/lab01/lab01.ipynb')
+
+
+def test_redirect_directory_and_other_files(index):
+    assert (redirect_url(index, CONFIG, 'alice', 'lab01') ==
+            '/user/alice/tree/lab/lab01')
+    assert (redirect_url(index, CONFIG, 'alice', 'lab01/data.csv') ==
+            '/user/alice/tree/lab/lab01/data.csv')
+
+
+def test_redirect_path_not_set(index):
+    config = dict(CONFIG, GIT_REDIRECT_PATH=None)
+    assert redirect_url(index, config, 'alice', 'lab01') is None
+    assert (redirect_url(index, config, 'alice', 'lab01/lab01.ipynb') ==
+            '/user/alice/notebooks/lab/lab01/lab01.ipynb')
@@ -0,0 +1,48 @@
+from app.warmup import Warmup
+
+CONFIG = {
+    'WARMUP_READY_ON_FAILURE': False,
+    'WARMUP_RETRY_MIN_S': 0,
+    'WARMUP_RETRY_MAX_S': 0,
+}
+
+
+def flaky(failures):
+    """A step that fails the given number of times, then passes."""
+    calls = []
+
+    def step():
+        calls.append(None)
+        if len(calls) <= failures:
+            raise RuntimeError('Github is down')
+        return len(calls)
+    return step
+
+
+def run(warmup, steps):
+    warmup.started_at = 0
+    warmup._run_steps(steps)
+    warmup.finished_at = 1
+    if warmup.failed:
+        warmup._retry(steps)
+
+
+def test_failed_step_retried_until_it_passes():
+    warmup = Warmup(CONFIG, None)
+    run(warmup, [('repo:lab', flaky(2)), ('hub', flaky(0))])
+
+    assert warmup.ready
+    assert warmup.steps['repo:lab']['attempts'] == 3
+    assert warmup.steps['repo:lab']['error'] is None
+    # Steps that passed aren't run again
+    assert warmup.steps['hub']['attempts'] == 1
+    assert warmup.status()['retry_in_s'] is None
+
+
+def test_not_ready_while_step_failing():
+    warmup = Warmup(CONFIG, None)
+    warmup._run_steps([('repo:lab', flaky(1))])
+    warmup.finished_at = 1
+
+    assert not warmup.ready
+    assert warmup.failed == ['repo:lab']